@@ -1,7 +1,7 @@
 import asyncio
 import os
 from datetime import datetime, timedelta
-from motor.motor_asyncio import AsyncIOMotorClient
+from main import create_mongo_client, MONGO_DB_NAME
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -63,14 +63,14 @@ async def add_sample_expenses():
         print(f"Connecting to: {mongo_uri}")
         
         # Create client
-        client = AsyncIOMotorClient(mongo_uri)
+        client = create_mongo_client(mongo_uri)
         
         # Test connection
         await client.admin.command('ping')
         print("✅ MongoDB connection successful!")
         
         # Get database
-        db = client['inventory_db']
+        db = client[MONGO_DB_NAME]
         expenses_collection = db.expenses
         
         # Check current expense count
@@ -81,6 +81,7 @@ async def add_sample_expenses():
             # Add sample expenses
             await expenses_collection.insert_many(SAMPLE_EXPENSES)
             print("✅ Sample expenses data inserted")
+            print("💡 Run python backfill_rollups.py to include them in dashboard totals")
         else:
             print("✅ Expenses collection already has data")
         
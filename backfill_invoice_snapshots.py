@@ -0,0 +1,23 @@
+import asyncio
+from main import connect_database, close_database, backfill_invoice_snapshots
+
+async def backfill_snapshots():
+    """Freeze customer and part details onto invoices created before snapshots existed"""
+    try:
+        client = connect_database()
+        
+        # Test connection
+        await client.admin.command('ping')
+        print("✅ MongoDB connection successful!")
+
+        updated = await backfill_invoice_snapshots()
+        print(f"✅ Snapshots written for {updated} invoices")
+
+        # Close connection
+        close_database()
+
+    except Exception as e:
+        print(f"❌ Error backfilling invoice snapshots: {e}")
+
+if __name__ == "__main__":
+    asyncio.run(backfill_snapshots())
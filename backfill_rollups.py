@@ -0,0 +1,23 @@
+import asyncio
+from main import connect_database, close_database, rebuild_daily_rollups
+
+async def backfill_rollups():
+    """Rebuild the daily_rollups collection from all invoices and expenses"""
+    try:
+        client = connect_database()
+        
+        # Test connection
+        await client.admin.command('ping')
+        print("✅ MongoDB connection successful!")
+
+        days = await rebuild_daily_rollups()
+        print(f"✅ Daily rollups rebuilt for {days} days")
+
+        # Close connection
+        close_database()
+
+    except Exception as e:
+        print(f"❌ Error backfilling daily rollups: {e}")
+
+if __name__ == "__main__":
+    asyncio.run(backfill_rollups())
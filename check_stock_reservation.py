@@ -0,0 +1,151 @@
+import asyncio
+import sys
+from datetime import datetime
+from bson import ObjectId
+import main
+from main import connect_database, close_database, record_sale, InsufficientStockError
+
+# Everything runs in a scratch database that is dropped afterwards, never in inventory_db
+CHECK_DB_NAME = "inventory_db_stock_check"
+
+failures = []
+
+def check(condition, message):
+    print(f"{'✅' if condition else '❌'} {message}")
+    if not condition:
+        failures.append(message)
+
+async def add_part(part_number, quantity, minimum=2):
+    part = {
+        "part_number": part_number,
+        "part_name": part_number,
+        "quantity_in_stock": quantity,
+        "minimum_stock_level": minimum,
+        **main.low_stock_fields(quantity, minimum),
+        "unit_price": 10.0
+    }
+    result = await main.parts_collection.insert_one(part)
+    return result.inserted_id
+
+def sale(lines):
+    """(invoice_data, sales_records, quantities, part_numbers) for {part_id: quantity}"""
+    now = datetime.now()
+    invoice_id = ObjectId()
+    invoice_data = {
+        "_id": invoice_id,
+        "invoice_number": f"CHECK-{invoice_id}",
+        "items": [],
+        "total": 10.0 * sum(lines.values()),
+        "created_at": now
+    }
+    sales_records = [
+        {"invoice_id": str(invoice_id), "part_id": part_id, "quantity_sold": quantity, "sold_at": now}
+        for part_id, quantity in lines.items()
+    ]
+    part_numbers = {part_id: str(part_id) for part_id in lines}
+    return invoice_data, sales_records, dict(lines), part_numbers
+
+async def check_part(part_id, quantity, label):
+    part = await main.parts_collection.find_one({"_id": part_id})
+    check(part["quantity_in_stock"] == quantity, f"{label}: stock is {part['quantity_in_stock']}, expected {quantity}")
+    check(not part.get("pending_sales"), f"{label}: no pending_sales markers left ({part.get('pending_sales')})")
+    expected = main.low_stock_fields(quantity, part["minimum_stock_level"])
+    check(
+        part.get("is_low_stock") == expected["is_low_stock"] and part.get("shortfall") == expected["shortfall"],
+        f"{label}: is_low_stock/shortfall are {part.get('is_low_stock')}/{part.get('shortfall')}"
+    )
+
+async def check_oversell_race():
+    """Twenty concurrent one-unit sales against five units: exactly five may succeed"""
+    part_id = await add_part("RACE-001", 5)
+    results = await asyncio.gather(
+        *(record_sale(*sale({part_id: 1})) for _ in range(20)), return_exceptions=True
+    )
+    sold = sum(1 for result in results if result is None)
+    others = [result for result in results if result is not None and not isinstance(result, InsufficientStockError)]
+    # Write conflicts between transactions are retried, so both paths sell exactly the stock there is
+    check(sold == 5, f"oversell race: {sold} of 20 sales went through, expected 5")
+    check(not others, f"oversell race: unexpected errors {others[:3]}")
+    await check_part(part_id, 5 - sold, "oversell race")
+    invoices = await main.invoices_collection.count_documents({"invoice_number": {"$regex": "^CHECK-"}})
+    check(invoices == sold, f"oversell race: {invoices} invoices written for {sold} sales")
+
+async def check_partial_reservation_rollback():
+    """A sale with one short line must give back the stock taken for the other lines"""
+    plenty = await add_part("ROLLBACK-001", 10)
+    scarce = await add_part("ROLLBACK-002", 1)
+    invoice_data, sales_records, quantities, part_numbers = sale({plenty: 3, scarce: 2})
+    try:
+        await record_sale(invoice_data, sales_records, quantities, part_numbers)
+        check(False, "partial reservation: sale of 2 units with 1 in stock was accepted")
+    except InsufficientStockError as e:
+        check(
+            [s["requested"] for s in e.shortages] == [2],
+            f"partial reservation: shortages reported as {e.shortages}"
+        )
+    await check_part(plenty, 10, "partial reservation (covered line)")
+    await check_part(scarce, 1, "partial reservation (short line)")
+    invoice = await main.invoices_collection.find_one({"_id": invoice_data["_id"]})
+    check(invoice is None, "partial reservation: no invoice written")
+
+async def check_failed_write_cleanup():
+    """When writing the sales lines fails after the reservation, stock and markers are restored"""
+    part_id = await add_part("CLEANUP-001", 4)
+    invoice_data, sales_records, quantities, part_numbers = sale({part_id: 3})
+    # Two sales lines with the same _id make insert_many fail after the stock was taken
+    duplicate_id = ObjectId()
+    sales_records = [dict(sales_records[0], _id=duplicate_id), dict(sales_records[0], _id=duplicate_id)]
+    try:
+        await record_sale(invoice_data, sales_records, quantities, part_numbers)
+        check(False, "failed write: duplicate sales lines were accepted")
+    except InsufficientStockError:
+        check(False, "failed write: reported as insufficient stock")
+    except Exception:
+        check(True, "failed write: sale raised")
+    await check_part(part_id, 4, "failed write")
+    invoice = await main.invoices_collection.find_one({"_id": invoice_data["_id"]})
+    check(invoice is None, "failed write: invoice removed")
+    lines = await main.sales_collection.count_documents({"invoice_id": str(invoice_data["_id"])})
+    check(lines == 0, f"failed write: {lines} sales lines left behind")
+
+async def check_successful_sale_cleanup():
+    """A completed sale leaves the stock reduced, the flags updated and no marker behind"""
+    part_id = await add_part("SALE-001", 3, minimum=2)
+    await record_sale(*sale({part_id: 2}))
+    await check_part(part_id, 1, "completed sale")
+
+async def check_stock_reservation():
+    """Check stock reservation, rollback and marker cleanup against a scratch database"""
+    try:
+        main.MONGO_DB_NAME = CHECK_DB_NAME
+        client = connect_database()
+        await client.admin.command('ping')
+        print("✅ MongoDB connection successful!")
+        await client.drop_database(CHECK_DB_NAME)
+
+        hello = await client.admin.command('hello')
+        transactions = bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+        # The marker path runs everywhere; the transaction path only on a replica set or cluster
+        for use_transactions in ([False, True] if transactions else [False]):
+            main.SUPPORTS_TRANSACTIONS = use_transactions
+            mode = "transactions" if main.SUPPORTS_TRANSACTIONS else "reservation markers"
+            print(f"\nChecking with {mode}")
+            await main.parts_collection.delete_many({})
+            await main.invoices_collection.delete_many({})
+            await main.sales_collection.delete_many({})
+            await check_oversell_race()
+            await check_partial_reservation_rollback()
+            await check_failed_write_cleanup()
+            await check_successful_sale_cleanup()
+
+        await client.drop_database(CHECK_DB_NAME)
+        close_database()
+    except Exception as e:
+        print(f"❌ Error checking stock reservation: {e}")
+        failures.append(str(e))
+
+    print(f"\n{'✅ All stock checks passed' if not failures else f'❌ {len(failures)} stock checks failed'}")
+    return not failures
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(check_stock_reservation()) else 1)
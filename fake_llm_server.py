@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI chat completions API, for tests and load runs
+
+Run it, then point the app at it:
+    python fake_llm_server.py
+    OPENAI_API_KEY=fake OPENAI_BASE_URL=http://localhost:8001/v1 python start.py
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Seconds before the first token, seconds between tokens, and share of requests answered with 503
+FAKE_LLM_PORT = int(os.getenv('FAKE_LLM_PORT', '8001'))
+FAKE_LLM_LATENCY = float(os.getenv('FAKE_LLM_LATENCY', '0.3'))
+FAKE_LLM_TOKEN_DELAY = float(os.getenv('FAKE_LLM_TOKEN_DELAY', '0.02'))
+FAKE_LLM_FAILURE_RATE = float(os.getenv('FAKE_LLM_FAILURE_RATE', '0'))
+
+app = FastAPI(title="Fake LLM")
+
+def build_answer(messages):
+    """Deterministic answer that shows what the model was given"""
+    question = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+    system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    part_lines = [line for line in system.splitlines() if line.strip().startswith("- ")]
+    return (
+        f"(fake model) You asked: {question}. "
+        f"I was given {len(part_lines)} inventory lines and {len(messages)} messages of context."
+    )
+
+def completion_chunk(completion_id, model, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+@app.post('/v1/chat/completions')
+async def chat_completions(request: Request):
+    data = await request.json()
+    model = data.get("model", "fake-model")
+    messages = data.get("messages", [])
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    if random.random() < FAKE_LLM_FAILURE_RATE:
+        return JSONResponse({"error": {"message": "Simulated overload", "type": "server_error"}}, status_code=503)
+
+    await asyncio.sleep(FAKE_LLM_LATENCY)
+    answer = build_answer(messages)
+    tokens = answer.split(" ")
+
+    if not data.get("stream"):
+        await asyncio.sleep(FAKE_LLM_TOKEN_DELAY * len(tokens))
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in messages)
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(tokens),
+                "total_tokens": prompt_tokens + len(tokens)
+            }
+        })
+
+    async def event_stream():
+        yield f"data: {json.dumps(completion_chunk(completion_id, model, {'role': 'assistant', 'content': ''}))}\n\n"
+        for i, token in enumerate(tokens):
+            content = token if i == 0 else f" {token}"
+            yield f"data: {json.dumps(completion_chunk(completion_id, model, {'content': content}))}\n\n"
+            await asyncio.sleep(FAKE_LLM_TOKEN_DELAY)
+        yield f"data: {json.dumps(completion_chunk(completion_id, model, {}, 'stop'))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+if __name__ == "__main__":
+    import uvicorn
+    print(f"🤖 Fake LLM listening on http://localhost:{FAKE_LLM_PORT}/v1")
+    uvicorn.run(app, host="0.0.0.0", port=FAKE_LLM_PORT)
@@ -0,0 +1,24 @@
+"""
+Gunicorn settings for running the app on every core of the shop server
+
+    gunicorn main:app -c gunicorn.conf.py
+
+Each worker is a separate process with its own inventory snapshot, chat
+cache and job workers; they stay consistent through MongoDB (change
+streams or polling, the shared jobs queue and the startup lock).
+"""
+
+import os
+import multiprocessing
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', str(multiprocessing.cpu_count())))
+worker_class = 'uvicorn.workers.UvicornWorker'
+# Startup waits on the startup lock and loads the inventory, so give workers room to boot
+timeout = int(os.getenv('WORKER_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then so memory growth in long-lived processes stays bounded
+max_requests = int(os.getenv('MAX_REQUESTS', '5000'))
+max_requests_jitter = 500
+accesslog = '-'
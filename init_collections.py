@@ -1,9 +1,10 @@
 import asyncio
 import os
+import sys
 from datetime import datetime
-from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 import uuid
+from main import create_mongo_client, ensure_indexes, check_query_plans, MONGO_DB_NAME
 
 load_dotenv()
 
@@ -51,22 +52,22 @@ def get_password_hash(password):
     import hashlib
     return hashlib.sha256(password.encode()).hexdigest()
 
-async def init_collections():
-    """Initialize missing collections and sample data"""
+async def init_collections(check_plans=False):
+    """Initialize missing collections, sample data and indexes"""
     try:
         # Get MongoDB URI from environment or use default
         mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
         print(f"Connecting to: {mongo_uri}")
         
         # Create client
-        client = AsyncIOMotorClient(mongo_uri)
+        client = create_mongo_client(mongo_uri)
         
         # Test connection
         await client.admin.command('ping')
         print("✅ MongoDB connection successful!")
         
         # Get database
-        db = client['inventory_db']
+        db = client[MONGO_DB_NAME]
         print("✅ Database 'inventory_db' accessible")
         
         # Initialize customers collection
@@ -123,9 +124,26 @@ async def init_collections():
         print(f"Chat sessions collection: {chat_count} documents")
         print("✅ Chat sessions collection ready")
         
+        # Apply the index manifest
+        failed_indexes = await ensure_indexes(db)
+        if failed_indexes:
+            print(f"❌ Could not create indexes: {', '.join(failed_indexes)}")
+        else:
+            print("✅ Indexes created")
+        
+        # Verify that hot queries use an index
+        scans = []
+        if check_plans:
+            scans = await check_query_plans(db)
+            for scan in scans:
+                print(f"❌ Collection scan: {scan['collection']} {scan['query']} sort={scan['sort']} -> {scan['stages']}")
+            if not scans:
+                print("✅ All hot queries use an index")
+        
         # Close connection
         client.close()
         print("✅ All collections initialized successfully!")
+        return not failed_indexes and not scans
         
     except Exception as e:
         print(f"❌ Error initializing collections: {e}")
@@ -133,6 +151,10 @@ async def init_collections():
         print("1. Make sure MongoDB is running")
         print("2. Check if you have write permissions to the database")
         print("3. Verify the MONGO_URI in your .env file")
+        return False
 
 if __name__ == "__main__":
-    asyncio.run(init_collections()) 
\ No newline at end of file
+    # --check explains each hot query and exits non-zero if any is a collection scan
+    ok = asyncio.run(init_collections(check_plans="--check" in sys.argv))
+    if "--check" in sys.argv and not ok:
+        sys.exit(1) 
\ No newline at end of file
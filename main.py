@@ -1,17 +1,20 @@
 import os
 import json
 from datetime import datetime, timedelta, date
-from typing import List, Optional
-from fastapi import FastAPI, Request, Form, Depends, status, HTTPException, UploadFile, File, BackgroundTasks
+from typing import Optional
+from fastapi import FastAPI, Request, Form, Depends, HTTPException, UploadFile, File
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import monitoring, ReadPreference, ReturnDocument, UpdateOne, ReplaceOne, IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, PyMongoError, BulkWriteError, DuplicateKeyError
 from dotenv import load_dotenv
-from openai import OpenAI  # type: ignore
-import pandas as pd
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError  # type: ignore
+import random
 import io
 import csv
 from passlib.context import CryptContext
@@ -21,16 +24,39 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from contextlib import asynccontextmanager
 import uuid
+import time
+import socket
+import threading
+import asyncio
+import re
+import math
+import bisect
+import heapq
+import itertools
+import hashlib
+import importlib.util
+from collections import defaultdict, OrderedDict, Counter
 
 load_dotenv()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    connect_database()
     await init_db()
+    await inventory_snapshot.load()
+    inventory_snapshot.start()
+    await pricing_engine.load()
+    pricing_engine.start()
+    job_queue.start()
     yield
     # Shutdown
-    pass
+    await job_queue.stop()
+    await pricing_engine.stop()
+    await inventory_snapshot.stop()
+    if openai_client:
+        await openai_client.close()
+    close_database()
 
 app = FastAPI(title="SLN AUTOMOBILES INVENTORY", lifespan=lifespan)
 
@@ -45,35 +71,202 @@ templates = Jinja2Templates(directory=TEMPLATES_DIR)
 
 # MongoDB connection
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(MONGO_URI)
-db = client['inventory_db']
+MONGO_DB_NAME = 'inventory_db'
+# Connection pool, per process; with several workers the server sees workers x MONGO_MAX_POOL_SIZE
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '50'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '5'))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', '300000'))
+# How long a request waits for a free pooled connection before failing instead of piling up
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '10000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_READ_PREFERENCE = os.getenv('MONGO_READ_PREFERENCE', 'primary')
+# e.g. "zstd,snappy,zlib"; zstd and snappy need the zstandard / python-snappy packages
+MONGO_COMPRESSORS = os.getenv('MONGO_COMPRESSORS', '')
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool counters and checkout wait times from driver events.
+
+    The driver reports these from its worker threads, hence the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = Counter()
+        self.pool_clears = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+
+    def _waited_ms(self, event):
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            return duration * 1000
+        started = getattr(self.local, "started", None)
+        return (time.perf_counter() - started) * 1000 if started is not None else 0.0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.checkout_failures[str(event.reason)] += 1
+
+    def connection_checked_out(self, event):
+        waited = self._waited_ms(event)
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.wait_total_ms += waited
+            self.wait_max_ms = max(self.wait_max_ms, waited)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                "min_pool_size": MONGO_MIN_POOL_SIZE,
+                "open_connections": self.created - self.closed,
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": dict(self.checkout_failures),
+                "avg_checkout_wait_ms": round(self.wait_total_ms / self.checkouts, 3) if self.checkouts else None,
+                "max_checkout_wait_ms": round(self.wait_max_ms, 3),
+                "pool_clears": self.pool_clears,
+            }
+
+pool_metrics = PoolMetrics()
+
+def create_mongo_client(uri=MONGO_URI, **overrides):
+    """Motor client with the app's pool, timeout, read preference and compression settings"""
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "readPreference": MONGO_READ_PREFERENCE,
+        "appname": "sln-inventory",
+        "event_listeners": [pool_metrics],
+    }
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    options.update(overrides)
+    return AsyncIOMotorClient(uri, **options)
+
+# Bound by connect_database() in lifespan, or by a script, before first use
+client = None
+db = None
 
 # Collections
-parts_collection = db.parts
-sales_collection = db.sales
-invoices_collection = db.invoices
-expenses_collection = db.expenses
-customers_collection = db.customers
-users_collection = db.users
-chat_sessions_collection = db.chat_sessions
+parts_collection = None
+sales_collection = None
+invoices_collection = None
+expenses_collection = None
+customers_collection = None
+users_collection = None
+chat_sessions_collection = None
+daily_rollups_collection = None
+jobs_collection = None
+locks_collection = None
+pricing_rules_collection = None
+
+def connect_database(mongo_client=None):
+    """Create (or adopt) the client and bind the module-level database and collections"""
+    global client, db, parts_collection, sales_collection, invoices_collection, expenses_collection
+    global customers_collection, users_collection, chat_sessions_collection, daily_rollups_collection
+    global jobs_collection, locks_collection, pricing_rules_collection
+    client = mongo_client or create_mongo_client()
+    db = client[MONGO_DB_NAME]
+    parts_collection = db.parts
+    sales_collection = db.sales
+    invoices_collection = db.invoices
+    expenses_collection = db.expenses
+    customers_collection = db.customers
+    users_collection = db.users
+    chat_sessions_collection = db.chat_sessions
+    daily_rollups_collection = db.daily_rollups
+    jobs_collection = db.jobs
+    locks_collection = db.locks
+    pricing_rules_collection = db.pricing_rules
+    return client
+
+def on_primary(collection):
+    """The collection with reads pinned to the primary, for reads that must see a write just made
+    even when MONGO_READ_PREFERENCE sends other reads to secondaries"""
+    return collection.with_options(read_preference=ReadPreference.PRIMARY)
+
+def close_database():
+    if client is not None:
+        client.close()
+
+# Set by init_db once the deployment type is known
+SUPPORTS_TRANSACTIONS = False
 
 # Security
 SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-here')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-security = HTTPBearer()
+# auto_error off so requests without the header can fall back to the login cookie
+security = HTTPBearer(auto_error=False)
 
 # OpenAI
 openai_api_key = os.getenv('OPENAI_API_KEY')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '30'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '8'))
 openai_client = None
 if openai_api_key:
     try:
-        openai_client = OpenAI(api_key=openai_api_key)
+        # Retries are handled by complete_chat so they share the concurrency limit
+        openai_client = AsyncOpenAI(
+            api_key=openai_api_key,
+            base_url=OPENAI_BASE_URL,
+            timeout=OPENAI_TIMEOUT_SECONDS,
+            max_retries=0
+        )
     except Exception as e:
         print(f"Warning: Could not initialize OpenAI client: {e}")
         openai_client = None
 
+# Number of parts retrieved into the chat prompt per message
+CHAT_CONTEXT_TOP_K = int(os.getenv('CHAT_CONTEXT_TOP_K', '25'))
+
 # Sample data for initialization
 SAMPLE_PARTS = [
     {
@@ -116,6 +309,7 @@ SAMPLE_CUSTOMERS = [
         "email": "john.doe@email.com",
         "phone": "+1234567890",
         "address": "123 Main St, City, State 12345",
+        "pricing_tier": "regular",
         "created_at": datetime.now()
     },
     {
@@ -124,12 +318,276 @@ SAMPLE_CUSTOMERS = [
         "email": "jane.smith@email.com",
         "phone": "+1987654321",
         "address": "456 Oak Ave, City, State 12345",
+        "pricing_tier": "wholesale",
         "created_at": datetime.now()
     }
 ]
 
 
 
+# ==================== INDEXES ====================
+
+# Indexes every collection should have, applied at startup and by init_collections.py
+INDEX_MANIFEST = {
+    "parts": [
+        IndexModel([("part_number", ASCENDING)], name="part_number_unique", unique=True),
+        IndexModel(
+            [("vehicles.make", ASCENDING), ("vehicles.model", ASCENDING),
+             ("vehicles.year_from", ASCENDING), ("vehicles.year_to", ASCENDING)],
+            name="vehicles_make_model_years"
+        ),
+        IndexModel([("category", ASCENDING), ("part_number", ASCENDING)], name="category_part_number"),
+        IndexModel([("brand", ASCENDING), ("part_number", ASCENDING)], name="brand_part_number"),
+        # Used by the inventory snapshot's polling fallback to find changed parts
+        IndexModel([("updated_at", DESCENDING)], name="updated_at_desc"),
+        IndexModel([("created_at", DESCENDING)], name="created_at_desc"),
+        # Only parts below their minimum are indexed, so the index stays as small as the reorder list
+        IndexModel(
+            [("shortfall", DESCENDING), ("supplier", ASCENDING)],
+            name="low_stock_shortfall",
+            partialFilterExpression={"is_low_stock": True}
+        ),
+    ],
+    "customers": [
+        IndexModel([("customer_id", ASCENDING)], name="customer_id_unique", unique=True),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "chat_sessions": [
+        IndexModel([("session_id", ASCENDING)], name="session_id_unique", unique=True),
+    ],
+    "invoices": [
+        IndexModel([("created_at", DESCENDING)], name="created_at_desc"),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at_id_desc"),
+        IndexModel([("customer_id", ASCENDING)], name="customer_id"),
+    ],
+    "sales": [
+        IndexModel([("invoice_id", ASCENDING)], name="invoice_id"),
+        IndexModel([("part_id", ASCENDING), ("sold_at", DESCENDING)], name="part_id_sold_at"),
+        IndexModel([("sold_at", DESCENDING)], name="sold_at_desc"),
+    ],
+    "expenses": [
+        IndexModel([("date", DESCENDING)], name="date_desc"),
+    ],
+    "daily_rollups": [
+        IndexModel([("date", ASCENDING)], name="date"),
+    ],
+    "jobs": [
+        IndexModel([("type", ASCENDING), ("created_at", DESCENDING)], name="type_created_at"),
+        IndexModel([("status", ASCENDING), ("run_after", ASCENDING)], name="status_run_after"),
+    ],
+}
+
+def hot_queries():
+    """Representative filters and sorts of the lookups main.py makes on every request"""
+    recent = datetime.now() - timedelta(days=30)
+    return [
+        ("parts", {"part_number": "BOS-001"}, None),
+        ("parts", {"part_number": {"$gt": "BOS-001"}}, [("part_number", ASCENDING)]),
+        ("parts", {"category": "Filters", "part_number": {"$gt": "BOS-001"}}, [("part_number", ASCENDING)]),
+        ("parts", {"vehicles": {"$elemMatch": vehicle_fit_filter("honda", "civic", 2020)}}, None),
+        ("parts", {"is_low_stock": True}, [("shortfall", DESCENDING)]),
+        ("parts", {"$or": [{"updated_at": {"$gte": recent}}, {"created_at": {"$gte": recent}}]}, None),
+        ("customers", {"customer_id": "CUST001"}, None),
+        ("users", {"username": "admin"}, None),
+        ("chat_sessions", {"session_id": "00000000-0000-0000-0000-000000000000"}, None),
+        ("invoices", {}, [("created_at", DESCENDING)]),
+        ("invoices", {"created_at": {"$lt": recent}}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+        ("invoices", {"created_at": {"$gte": recent}}, None),
+        ("sales", {"invoice_id": "000000000000000000000000"}, None),
+        ("sales", {"sold_at": {"$gte": recent}}, None),
+        ("expenses", {"date": {"$gte": recent}}, [("date", DESCENDING)]),
+        ("daily_rollups", {"date": {"$gte": recent}}, None),
+    ]
+
+async def ensure_indexes(database):
+    """Create the indexes in INDEX_MANIFEST; returns the names that could not be created"""
+    failed = []
+    for collection_name, indexes in INDEX_MANIFEST.items():
+        for index in indexes:
+            try:
+                await database[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                # e.g. existing duplicates blocking a unique index, or a conflicting index definition
+                name = index.document["name"]
+                print(f"Could not create index {collection_name}.{name}: {e}")
+                failed.append(f"{collection_name}.{name}")
+    return failed
+
+def plan_stages(plan):
+    """Every stage name in an explain() plan tree"""
+    plan = plan.get("queryPlan", plan)
+    stages = [plan.get("stage")]
+    if "inputStage" in plan:
+        stages += plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+async def check_query_plans(database):
+    """Explain each hot query and return those whose winning plan is a collection scan"""
+    scans = []
+    for collection_name, query, sort in hot_queries():
+        cursor = database[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        stages = plan_stages(explanation["queryPlanner"]["winningPlan"])
+        if "COLLSCAN" in stages:
+            scans.append({"collection": collection_name, "query": str(query), "sort": str(sort), "stages": stages})
+    return scans
+
+# ==================== VEHICLE COMPATIBILITY ====================
+
+# Year bounds stored when the text gives no year, or an open-ended range like "2018+"
+ANY_YEAR_FROM = 1900
+ANY_YEAR_TO = 9999
+
+# Makes written as two words; any other make is the first word of an entry
+MULTI_WORD_MAKES = {
+    "alfa romeo", "aston martin", "land rover", "mercedes benz", "rolls royce", "great wall", "maruti suzuki"
+}
+
+VEHICLE_YEARS_RE = re.compile(
+    r'\b((?:19|20)\d{2})\s*(?:(?:-|to|–)\s*((?:19|20)\d{2}|present|now|onwards?)|(\+|onwards?))?',
+    re.IGNORECASE
+)
+
+def parse_vehicle_compatibility(text):
+    """Parse free text like "Honda Civic 2018-2023, Toyota Camry 2019+" into vehicle fits.
+
+    Each comma or semicolon separated entry becomes
+    {"make", "model", "year_from", "year_to"} with make and model normalized
+    by normalize_vehicle_words. The make is the first word, or the first two
+    for MULTI_WORD_MAKES, and the remaining words before the years are the
+    model; entries without years fit every year.
+    """
+    vehicles = []
+    for entry in re.split(r'[,;\n]', str(text or "")):
+        entry = entry.strip()
+        if not entry:
+            continue
+        match = VEHICLE_YEARS_RE.search(entry)
+        year_from, year_to = ANY_YEAR_FROM, ANY_YEAR_TO
+        name = entry
+        if match:
+            name = entry[:match.start()]
+            year_from = int(match.group(1))
+            if match.group(2) and match.group(2)[0].isdigit():
+                year_to = int(match.group(2))
+            elif match.group(2) or match.group(3):
+                year_to = ANY_YEAR_TO
+            else:
+                year_to = year_from
+            if year_to < year_from:
+                year_from, year_to = year_to, year_from
+        words = normalize_vehicle_words(name).split()
+        if not words:
+            continue
+        make_length = 2 if " ".join(words[:2]) in MULTI_WORD_MAKES else 1
+        vehicles.append({
+            "make": " ".join(words[:make_length]),
+            "model": " ".join(words[make_length:]),
+            "year_from": year_from,
+            "year_to": year_to
+        })
+    return vehicles
+
+def normalize_vehicle_words(text):
+    """Lowercase words with punctuation dropped, so "Mercedes-Benz" and "mercedes benz" are equal.
+
+    Used both when parsing vehicle_compatibility and when building the query filter.
+    """
+    return " ".join(re.findall(r'[a-z0-9]+', str(text or "").lower()))
+
+def vehicle_fit_filter(make, model=None, year=None):
+    """$elemMatch body selecting vehicles that match the make, model and year"""
+    condition = {"make": normalize_vehicle_words(make)}
+    if model:
+        condition["model"] = normalize_vehicle_words(model)
+    if year:
+        condition["year_from"] = {"$lte": year}
+        condition["year_to"] = {"$gte": year}
+    return condition
+
+async def backfill_vehicle_fits():
+    """Parse vehicle_compatibility into vehicles for parts written before it existed,
+    or parsed before their two-word make was recognized"""
+    split_makes = [
+        {"vehicles": {"$elemMatch": {"make": first, "model": {"$regex": f"^{re.escape(second)}( |$)"}}}}
+        for first, second in (make.split(" ", 1) for make in MULTI_WORD_MAKES)
+    ]
+    operations = []
+    query = {"$or": [{"vehicles": {"$exists": False}}, *split_makes]}
+    async for part in parts_collection.find(query, {"vehicle_compatibility": 1}):
+        operations.append(UpdateOne(
+            {"_id": part["_id"]},
+            {"$set": {"vehicles": parse_vehicle_compatibility(part.get("vehicle_compatibility"))}}
+        ))
+    for i in range(0, len(operations), 1000):
+        await parts_collection.bulk_write(operations[i:i + 1000], ordered=False)
+    return len(operations)
+
+# ==================== LOW STOCK ====================
+
+# Recomputes is_low_stock and shortfall from the document itself; appended to every
+# pipeline update that changes quantity_in_stock so the flags move in the same write
+LOW_STOCK_STAGE = {"$set": {
+    "is_low_stock": {"$lt": [{"$ifNull": ["$quantity_in_stock", 0]}, {"$ifNull": ["$minimum_stock_level", 0]}]},
+    "shortfall": {"$max": [
+        {"$subtract": [{"$ifNull": ["$minimum_stock_level", 0]}, {"$ifNull": ["$quantity_in_stock", 0]}]}, 0
+    ]}
+}}
+
+def low_stock_fields(quantity_in_stock, minimum_stock_level):
+    """is_low_stock and shortfall for writes that set the stock levels outright"""
+    quantity_in_stock = quantity_in_stock or 0
+    minimum_stock_level = minimum_stock_level or 0
+    return {
+        "is_low_stock": quantity_in_stock < minimum_stock_level,
+        "shortfall": max(minimum_stock_level - quantity_in_stock, 0)
+    }
+
+async def backfill_low_stock():
+    """Compute is_low_stock and shortfall for parts written before they existed"""
+    result = await parts_collection.update_many({"is_low_stock": {"$exists": False}}, [LOW_STOCK_STAGE])
+    return result.modified_count
+
+# ==================== STARTUP LOCK ====================
+
+# Identifies this process as a lock owner when several workers share the database
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+STARTUP_LOCK = "startup"
+STARTUP_LOCK_SECONDS = float(os.getenv('STARTUP_LOCK_SECONDS', '300'))
+
+async def acquire_lock(name, owner, ttl_seconds):
+    """Take the named lock document unless another owner holds an unexpired one"""
+    now = datetime.now()
+    try:
+        await locks_collection.find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "acquired_at": now, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The lock exists and is held, so the upsert tried to insert a second one
+        return False
+
+async def release_lock(name, owner):
+    await locks_collection.delete_one({"_id": name, "owner": owner})
+
+async def wait_for_lock_release(name, timeout):
+    """Wait until the lock is released or expires; returns False on timeout"""
+    deadline = datetime.now() + timedelta(seconds=timeout)
+    while datetime.now() < deadline:
+        lock = await on_primary(locks_collection).find_one({"_id": name})
+        if lock is None or lock["expires_at"] < datetime.now():
+            return True
+        await asyncio.sleep(0.5)
+    return False
+
 # Initialize database with sample data
 async def init_db():
     try:
@@ -140,50 +598,99 @@ async def init_db():
         await client.admin.command('ping')
         print("Database connection successful")
         
-        # Check if parts collection is empty
-        count = await parts_collection.count_documents({})
-        print(f"Parts collection count: {count}")
-        if count == 0:
-            await parts_collection.insert_many(SAMPLE_PARTS)
-            print("Sample parts data inserted")
-        
-        # Check if customers collection is empty
-        customer_count = await customers_collection.count_documents({})
-        print(f"Customers collection count: {customer_count}")
-        if customer_count == 0:
-            await customers_collection.insert_many(SAMPLE_CUSTOMERS)
-            print("Sample customers data inserted")
-        
-        # Check if users collection is empty
-        user_count = await users_collection.count_documents({})
-        print(f"Users collection count: {user_count}")
-        if user_count == 0:
-            # Create sample users with proper password hashing
-            sample_users = []
-            for user_data in SAMPLE_USERS_DATA:
-                user = {
-                    "username": user_data["username"],
-                    "email": user_data["email"],
-                    "hashed_password": get_password_hash(user_data["password"]),
-                    "role": user_data["role"],
-                    "full_name": user_data["full_name"],
-                    "is_active": user_data["is_active"],
-                    "created_at": datetime.now()
-                }
-                sample_users.append(user)
-            
-            await users_collection.insert_many(sample_users)
-            print("Sample users data inserted")
+        # Multi-document transactions need a replica set or sharded cluster
+        global SUPPORTS_TRANSACTIONS
+        hello = await client.admin.command('hello')
+        SUPPORTS_TRANSACTIONS = bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+        print(f"Transactions supported: {SUPPORTS_TRANSACTIONS}")
         
-        # Check invoices collection
-        invoice_count = await invoices_collection.count_documents({})
-        print(f"Invoices collection count: {invoice_count}")
+        # With several workers only one runs the seeding and backfills; the rest wait for it
+        if await acquire_lock(STARTUP_LOCK, INSTANCE_ID, STARTUP_LOCK_SECONDS):
+            try:
+                await run_startup_tasks()
+            finally:
+                await release_lock(STARTUP_LOCK, INSTANCE_ID)
+        else:
+            print("Another worker is running the startup tasks, waiting for it to finish")
+            if not await wait_for_lock_release(STARTUP_LOCK, STARTUP_LOCK_SECONDS):
+                print("Warning: timed out waiting for the startup tasks of another worker")
             
     except Exception as e:
         print(f"Database initialization error: {e}")
         print("Make sure MongoDB is running on localhost:27017")
         print("You may need to install MongoDB or start the MongoDB service")
 
+async def run_startup_tasks():
+    """Indexes, sample data and backfills; run by one process at a time under the startup lock"""
+    failed_indexes = await ensure_indexes(db)
+    print(f"Indexes ensured ({len(failed_indexes)} failed)")
+    if os.getenv('CHECK_QUERY_PLANS', '').lower() in ('1', 'true', 'yes'):
+        for scan in await check_query_plans(db):
+            print(f"Warning: collection scan for {scan['collection']} {scan['query']}: {scan['stages']}")
+    
+    # Check if parts collection is empty
+    count = await parts_collection.count_documents({})
+    print(f"Parts collection count: {count}")
+    if count == 0:
+        await parts_collection.insert_many(SAMPLE_PARTS)
+        print("Sample parts data inserted")
+    
+    # Structure free-text vehicle compatibility of older parts
+    parsed = await backfill_vehicle_fits()
+    if parsed:
+        print(f"Vehicle compatibility parsed for {parsed} parts")
+    
+    # Low-stock flags for seeded parts and parts from before they were maintained
+    flagged = await backfill_low_stock()
+    if flagged:
+        print(f"Low-stock flags computed for {flagged} parts")
+    
+    # Check if customers collection is empty
+    customer_count = await customers_collection.count_documents({})
+    print(f"Customers collection count: {customer_count}")
+    if customer_count == 0:
+        await customers_collection.insert_many(SAMPLE_CUSTOMERS)
+        print("Sample customers data inserted")
+    
+    # Check if users collection is empty
+    user_count = await users_collection.count_documents({})
+    print(f"Users collection count: {user_count}")
+    if user_count == 0:
+        # Create sample users with proper password hashing
+        sample_users = []
+        for user_data in SAMPLE_USERS_DATA:
+            user = {
+                "username": user_data["username"],
+                "email": user_data["email"],
+                "hashed_password": get_password_hash(user_data["password"]),
+                "role": user_data["role"],
+                "full_name": user_data["full_name"],
+                "is_active": user_data["is_active"],
+                "created_at": datetime.now()
+            }
+            sample_users.append(user)
+        
+        await users_collection.insert_many(sample_users)
+        print("Sample users data inserted")
+    
+    # Default pricing rules reproduce the original wholesale/VIP discounts and 8% tax
+    if await pricing_rules_collection.count_documents({}) == 0:
+        await pricing_rules_collection.insert_many([
+            {**rule, "updated_at": datetime.now()} for rule in DEFAULT_PRICING_RULES
+        ])
+        print("Default pricing rules inserted")
+    
+    # Check invoices collection
+    invoice_count = await invoices_collection.count_documents({})
+    print(f"Invoices collection count: {invoice_count}")
+    
+    # Build the daily rollups the first time they are needed
+    rollup_count = await daily_rollups_collection.estimated_document_count()
+    expense_count = await expenses_collection.estimated_document_count()
+    if rollup_count == 0 and (invoice_count or expense_count):
+        days = await rebuild_daily_rollups()
+        print(f"Daily rollups backfilled for {days} days")
+
 # Authentication functions
 def verify_password(plain_password, hashed_password):
     try:
@@ -228,18 +735,91 @@ SAMPLE_USERS_DATA = [
     }
 ]
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+USER_CACHE_TTL_SECONDS = float(os.getenv('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_SIZE = 1000
+# Build the user from the signed token claims instead of looking it up; role and
+# account changes then take effect when the token expires
+AUTH_TRUST_TOKEN_CLAIMS = os.getenv('AUTH_TRUST_TOKEN_CLAIMS', '').lower() in ('1', 'true', 'yes')
+
+class UserCache:
+    """Short-lived cache of user documents for get_current_user.
+
+    Per process: changes made through update_user drop the entry here at
+    once, and other workers pick them up when the TTL runs out.
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=30.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        entry = self.entries.get(username)
+        if entry is None or (datetime.now() - entry[1]).total_seconds() > self.ttl_seconds:
+            self.entries.pop(username, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(username)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, username, user):
+        self.entries[username] = (user, datetime.now())
+        self.entries.move_to_end(username)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        self.entries.pop(username, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "ttl_seconds": self.ttl_seconds,
+            "trust_token_claims": AUTH_TRUST_TOKEN_CLAIMS,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+user_cache = UserCache(max_entries=USER_CACHE_SIZE, ttl_seconds=USER_CACHE_TTL_SECONDS)
+
+def request_token(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = None):
+    """Access token from the Authorization header, else from the cookie set by /login"""
+    if credentials is not None and credentials.credentials:
+        return credentials.credentials
+    return request.cookies.get("access_token")
+
+async def get_current_user(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    token = request_token(request, credentials)
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return await user_from_token(token)
+
+async def user_from_token(token):
+    """The active user a signed access token belongs to; raises 401 otherwise"""
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid credentials")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    user = await users_collection.find_one({"username": username})
+    if AUTH_TRUST_TOKEN_CLAIMS and payload.get("role"):
+        return {"username": username, "role": payload["role"], "is_active": True}
+    
+    user = user_cache.get(username)
     if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
+        user = await users_collection.find_one({"username": username}, {"hashed_password": 0})
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        user_cache.put(username, user)
+    if not user.get("is_active", True):
+        raise HTTPException(status_code=401, detail="Account is disabled")
     return user
 
 async def get_current_admin_user(current_user = Depends(get_current_user)):
@@ -247,19 +827,743 @@ async def get_current_admin_user(current_user = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+async def current_user_or_none(request: Request):
+    """The signed-in user from the bearer token or the login cookie, or None for anonymous callers"""
+    token = request_token(request, await security(request))
+    if not token:
+        return None
+    try:
+        return await user_from_token(token)
+    except HTTPException:
+        return None
+
+# ==================== INVENTORY RETRIEVAL ====================
+
+# Common words in counter questions that carry no part information
+SEARCH_STOPWORDS = {
+    "a", "an", "the", "and", "or", "for", "of", "to", "in", "on", "at", "is", "are",
+    "do", "does", "we", "i", "you", "have", "has", "any", "some", "me", "my", "our",
+    "what", "which", "who", "how", "many", "much", "show", "all", "with", "there",
+    "it", "this", "that", "can", "be", "available", "stock", "part", "parts", "please"
+}
+
+# Relative weight of a token match in each indexed field
+SEARCH_FIELD_WEIGHTS = {
+    "part_number": 3.0,
+    "part_name": 2.0,
+    "brand": 2.0,
+    "vehicle_compatibility": 1.5,
+    "category": 1.0,
+    "supplier": 0.5,
+}
+
+YEAR_RANGE_RE = re.compile(r'\b((?:19|20)\d{2})\s*-\s*((?:19|20)\d{2})\b')
+
+def singular(token):
+    return token[:-1] if len(token) > 3 and token.endswith("s") and not token.endswith("ss") else token
+
+def tokenize(text):
+    """Split text into lowercase alphanumeric tokens, dropping stopwords and plural 's'"""
+    tokens = re.findall(r'[a-z0-9]+', str(text or "").lower())
+    return [singular(t) for t in tokens if t not in SEARCH_STOPWORDS]
+
+def tokenize_prefix(text):
+    """Typeahead input as (finished tokens, word still being typed or None).
+
+    Finished words go through tokenize; the last word, unless followed by a
+    space, is only lowercased, since "the" may be the start of "thermostat".
+    """
+    text = str(text or "").lower()
+    words = re.findall(r'[a-z0-9]+', text)
+    if not words or not re.search(r'[a-z0-9]$', text):
+        return tokenize(text), None
+    return tokenize(" ".join(words[:-1])), words[-1]
+
+def normalize_part_number(part_number):
+    """Fold case and strip punctuation so 'BOS-001' and 'bos001' compare equal"""
+    return re.sub(r'[^a-z0-9]', '', str(part_number or "").lower())
+
+def part_tokens(part):
+    """Map every searchable token of a part to its best field weight"""
+    weights = {}
+    for field, weight in SEARCH_FIELD_WEIGHTS.items():
+        value = part.get(field)
+        if not value:
+            continue
+        tokens = tokenize(value)
+        if field == "part_number":
+            tokens.append(normalize_part_number(value))
+        if field == "vehicle_compatibility":
+            # Expand "2018-2023" so a question about a 2020 model matches
+            for start, end in YEAR_RANGE_RE.findall(str(value)):
+                start, end = int(start), int(end)
+                if 0 <= end - start <= 40:
+                    tokens.extend(str(year) for year in range(start, end + 1))
+        for token in tokens:
+            if token and weights.get(token, 0) < weight:
+                weights[token] = weight
+    return weights
+
+def stock_margin(part):
+    """Units in stock above the minimum level; negative when the part is low"""
+    return (part.get("quantity_in_stock") or 0) - (part.get("minimum_stock_level") or 0)
+
+class PartsIndex:
+    """In-memory inverted index over the parts collection, used for chat context and search.
+
+    Besides the token postings it keeps the vocabulary sorted so typeahead
+    prefixes resolve to a contiguous range with a binary search.
+    """
+
+    # Upper bound on vocabulary tokens a single typed prefix expands to
+    MAX_PREFIX_EXPANSION = 200
+    # Postings scanned for a query that is one very broad prefix such as "20"
+    SEARCH_SCAN_BUDGET = 20000
+
+    def __init__(self):
+        self.parts = {}
+        self.postings = defaultdict(dict)
+        self.vocabulary = []
+        # Ids of parts below their minimum stock, kept current by _index and remove
+        self.low_stock_ids = set()
+        self.loaded = False
+
+    def rebuild(self, parts):
+        """Rebuild the index from an iterable of part documents"""
+        self.parts = {}
+        self.postings = defaultdict(dict)
+        self.low_stock_ids = set()
+        for part in parts:
+            self._index(str(part["_id"]), part)
+        self.vocabulary = sorted(self.postings)
+        self.loaded = True
+
+    def _index(self, part_id, part):
+        self.parts[part_id] = part
+        if stock_margin(part) < 0:
+            self.low_stock_ids.add(part_id)
+        for token, weight in part_tokens(part).items():
+            self.postings[token][part_id] = weight
+
+    def _add_to_vocabulary(self, token):
+        position = bisect.bisect_left(self.vocabulary, token)
+        if position == len(self.vocabulary) or self.vocabulary[position] != token:
+            self.vocabulary.insert(position, token)
+
+    def _remove_from_vocabulary(self, token):
+        position = bisect.bisect_left(self.vocabulary, token)
+        if position < len(self.vocabulary) and self.vocabulary[position] == token:
+            del self.vocabulary[position]
+
+    def upsert(self, part):
+        """Add or replace a single part"""
+        part_id = str(part["_id"])
+        self.remove(part_id)
+        self._index(part_id, part)
+        for token in part_tokens(part):
+            self._add_to_vocabulary(token)
+
+    def remove(self, part_id):
+        """Drop a part and its postings"""
+        part = self.parts.pop(str(part_id), None)
+        if not part:
+            return
+        self.low_stock_ids.discard(str(part_id))
+        for token in part_tokens(part):
+            postings = self.postings.get(token)
+            if postings is not None:
+                postings.pop(str(part_id), None)
+                if not postings:
+                    del self.postings[token]
+                    self._remove_from_vocabulary(token)
+
+    def __len__(self):
+        return len(self.parts)
+
+    def search(self, text, top_k=CHAT_CONTEXT_TOP_K):
+        """Return up to top_k parts ranked by weighted idf of the matched tokens"""
+        query_tokens = set(tokenize(text))
+        query_tokens.update(normalize_part_number(t) for t in str(text or "").split())
+        total = len(self.parts) or 1
+        scores = defaultdict(float)
+        for token in query_tokens:
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for part_id, weight in postings.items():
+                scores[part_id] += idf * weight
+        ranked = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [self.parts[part_id] for part_id, _ in ranked]
+
+    def _expand_prefix(self, prefix):
+        """Vocabulary tokens starting with prefix"""
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        limit = min(len(self.vocabulary), start + self.MAX_PREFIX_EXPANSION)
+        end = bisect.bisect_left(self.vocabulary, prefix + "\uffff", start, limit)
+        return self.vocabulary[start:end]
+
+    def _prefix_postings(self, prefix):
+        """(token, postings, boost) for tokens starting with prefix, exact match then rarest first"""
+        entries = [
+            (token, self.postings[token], 1.0 if token == prefix else 0.7)
+            for token in self._expand_prefix(prefix)
+        ]
+        entries.sort(key=lambda entry: (entry[2] != 1.0, len(entry[1])))
+        return entries
+
+    def _partial_postings(self, partial):
+        """_prefix_postings for the word still being typed; indexed words are singular,
+        so "oils" also matches the token "oil" exactly"""
+        entries = self._prefix_postings(partial)
+        token = singular(partial)
+        if token != partial and token in self.postings:
+            entries.insert(0, (token, self.postings[token], 1.0))
+        return entries
+
+    def _score_prefix(self, entries, total, budget=None):
+        """Best score per part over the prefix's tokens, optionally stopping after budget postings"""
+        scores = {}
+        visited = 0
+        for _, postings, boost in entries:
+            idf = math.log(1 + total / len(postings))
+            items = postings.items()
+            if budget:
+                items = itertools.islice(items, budget - visited)
+            for part_id, weight in items:
+                score = idf * weight * boost
+                if score > scores.get(part_id, 0):
+                    scores[part_id] = score
+            visited += len(postings)
+            if budget and visited >= budget:
+                break
+        return scores
+
+    def _filter_prefix(self, entries, total, candidates):
+        """Keep candidates that also match the prefix, adding its score"""
+        idfs = [(postings, boost, math.log(1 + total / len(postings))) for _, postings, boost in entries]
+        result = {}
+        for part_id, base in candidates.items():
+            best = 0
+            for postings, boost, idf in idfs:
+                weight = postings.get(part_id)
+                if weight and idf * weight * boost > best:
+                    best = idf * weight * boost
+            if best:
+                result[part_id] = base + best
+        return result
+
+    def search_prefix(self, text, limit=20):
+        """Typeahead search: every query token must prefix-match a token of the part.
+
+        Prefixes are intersected starting from the one with the fewest
+        postings. A query that is a single very broad prefix only scans the
+        first SEARCH_SCAN_BUDGET postings, rarest tokens first. Anything with
+        a digit is also tried as a normalized part number prefix, so 'bos-0'
+        and 'BOS0' both find BOS-001.
+        """
+        total = len(self.parts) or 1
+        finished, partial = tokenize_prefix(text)
+        prefixes = list(dict.fromkeys(finished))
+        expanded = [self._prefix_postings(prefix) for prefix in prefixes]
+        if partial and partial not in prefixes:
+            prefixes.append(partial)
+            expanded.append(self._partial_postings(partial))
+        expanded.sort(key=lambda entries: sum(len(postings) for _, postings, _ in entries))
+        
+        combined = {}
+        if expanded:
+            budget = self.SEARCH_SCAN_BUDGET if len(expanded) == 1 else None
+            combined = self._score_prefix(expanded[0], total, budget)
+            for entries in expanded[1:]:
+                if not combined:
+                    break
+                size = sum(len(postings) for _, postings, _ in entries)
+                if len(combined) * len(entries) <= size:
+                    combined = self._filter_prefix(entries, total, combined)
+                else:
+                    scores = self._score_prefix(entries, total)
+                    combined = {part_id: score + scores[part_id] for part_id, score in combined.items() if part_id in scores}
+        
+        part_number_prefix = normalize_part_number(text)
+        if len(part_number_prefix) >= 2 and part_number_prefix not in prefixes and re.search(r'\d', part_number_prefix):
+            entries = self._prefix_postings(part_number_prefix)
+            for part_id, score in self._score_prefix(entries, total, self.SEARCH_SCAN_BUDGET).items():
+                combined[part_id] = max(combined.get(part_id, 0), score * 2)
+        
+        ranked = heapq.nlargest(limit, combined.items(), key=lambda item: item[1])
+        return [self.parts[part_id] for part_id, _ in ranked]
+
+    def low_stock(self, limit=CHAT_CONTEXT_TOP_K):
+        """Parts furthest below their minimum stock level"""
+        # Every low-stock part ranks ahead of every other, so when there are enough of them
+        # only those need ranking
+        if len(self.low_stock_ids) >= limit:
+            candidates = (self.parts[part_id] for part_id in self.low_stock_ids)
+        else:
+            candidates = self.parts.values()
+        return heapq.nsmallest(limit, candidates, key=stock_margin)
+
+parts_index = PartsIndex()
+
+def edit_distance(a, b, max_distance):
+    """Optimal string alignment distance (edits plus adjacent swaps), or max_distance + 1 if larger"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+def trigrams(text):
+    padded = f"$${text}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class PartNumberIndex:
+    """Normalized part number lookup with typo-tolerant suggestions.
+
+    Part numbers are folded with normalize_part_number for exact matches.
+    For misses, a trigram index narrows the catalogue to a few candidates
+    that are then ranked by edit distance.
+    """
+
+    # Candidates (by shared trigrams) that get a full edit distance check
+    MAX_CANDIDATES = 50
+
+    def __init__(self):
+        self.by_number = defaultdict(set)
+        self.by_trigram = defaultdict(set)
+        self.numbers = {}
+
+    def rebuild(self, parts):
+        self.by_number = defaultdict(set)
+        self.by_trigram = defaultdict(set)
+        self.numbers = {}
+        for part in parts:
+            self.upsert(part)
+
+    def upsert(self, part):
+        part_id = str(part["_id"])
+        self.remove(part_id)
+        number = normalize_part_number(part.get("part_number"))
+        if not number:
+            return
+        self.numbers[part_id] = number
+        self.by_number[number].add(part_id)
+        for gram in trigrams(number):
+            self.by_trigram[gram].add(number)
+
+    def remove(self, part_id):
+        number = self.numbers.pop(str(part_id), None)
+        if number is None:
+            return
+        ids = self.by_number[number]
+        ids.discard(str(part_id))
+        if not ids:
+            del self.by_number[number]
+            for gram in trigrams(number):
+                numbers = self.by_trigram.get(gram)
+                if numbers is not None:
+                    numbers.discard(number)
+                    if not numbers:
+                        del self.by_trigram[gram]
+
+    def exact(self, part_number):
+        """Ids of parts whose normalized number equals the query's"""
+        return self.by_number.get(normalize_part_number(part_number), set())
+
+    def suggest(self, part_number, limit=5):
+        """(part_id, distance) pairs for the closest part numbers within a small edit distance"""
+        query = normalize_part_number(part_number)
+        if not query:
+            return []
+        max_distance = 1 if len(query) <= 4 else 2
+        shared = Counter(itertools.chain.from_iterable(self.by_trigram.get(gram, ()) for gram in trigrams(query)))
+        candidates = shared.most_common(self.MAX_CANDIDATES)
+        ranked = []
+        for number, overlap in candidates:
+            distance = edit_distance(query, number, max_distance)
+            if distance <= max_distance:
+                ranked.append((distance, -overlap, number))
+        ranked.sort()
+        suggestions = []
+        for distance, _, number in ranked:
+            for part_id in sorted(self.by_number[number]):
+                suggestions.append((part_id, distance))
+        return suggestions[:limit]
+
+part_number_index = PartNumberIndex()
+
+class InventorySnapshot:
+    """Versioned in-memory copy of the parts collection.
+
+    Loaded once at startup and kept fresh from a MongoDB change stream, or by
+    polling for changed documents when the server is a standalone mongod
+    without change stream support. Every applied change bumps the version and
+    is mirrored into parts_index.
+    """
+
+    def __init__(self, poll_interval=5.0, poll_overlap=10.0):
+        self.parts = {}
+        self.version = 0
+        self.loaded = False
+        self.mode = None
+        self.poll_interval = poll_interval
+        # Writers stamp updated_at before their write lands, so a write can commit after
+        # one stamped later; each poll re-reads this far behind the newest stamp it has seen
+        self.poll_overlap = timedelta(seconds=poll_overlap)
+        self.last_synced_at = None
+        self.hits = 0
+        self.misses = 0
+        self.changes_applied = 0
+        self._watermark = None
+        self._task = None
+
+    async def load(self):
+        """Read the full parts collection and rebuild the index"""
+        try:
+            parts = {}
+            # Also reloaded right after imports, so it must not read a lagging secondary
+            async for part in on_primary(parts_collection).find():
+                parts[str(part["_id"])] = part
+            self.parts = parts
+            self._watermark = max((self._changed_at(part) for part in parts.values()), default=None)
+            parts_index.rebuild(parts.values())
+            part_number_index.rebuild(parts.values())
+            self.version += 1
+            self.loaded = True
+            self.last_synced_at = datetime.now()
+            print(f"Inventory snapshot loaded with {len(parts)} parts (version {self.version})")
+        except Exception as e:
+            print(f"Error loading inventory snapshot: {e}")
+
+    @staticmethod
+    def _changed_at(part):
+        return part.get("updated_at") or part.get("created_at")
+
+    def upsert(self, part):
+        """Apply an inserted or updated part document"""
+        part_id = str(part["_id"])
+        self.parts[part_id] = part
+        parts_index.upsert(part)
+        part_number_index.upsert(part)
+        chat_response_cache.invalidate_part(part_id)
+        changed_at = self._changed_at(part)
+        if changed_at and (self._watermark is None or changed_at > self._watermark):
+            self._watermark = changed_at
+        self.version += 1
+        self.changes_applied += 1
+
+    def remove(self, part_id):
+        """Apply a deleted part"""
+        if self.parts.pop(str(part_id), None) is not None:
+            parts_index.remove(part_id)
+            part_number_index.remove(part_id)
+            chat_response_cache.invalidate_part(part_id)
+            self.version += 1
+            self.changes_applied += 1
+
+    async def refresh(self, part_ids):
+        """Re-read specific parts after a write made elsewhere in this process"""
+        try:
+            found = set()
+            async for part in on_primary(parts_collection).find({"_id": {"$in": list(part_ids)}}):
+                found.add(str(part["_id"]))
+                self.upsert(part)
+            for part_id in part_ids:
+                if str(part_id) not in found:
+                    self.remove(part_id)
+        except PyMongoError as e:
+            print(f"Error refreshing inventory snapshot: {e}")
+
+    async def get_parts(self):
+        """All parts, served from memory once the snapshot is loaded"""
+        if self.loaded:
+            self.hits += 1
+        else:
+            self.misses += 1
+            await self.load()
+            if not self.loaded:
+                raise RuntimeError("Inventory snapshot unavailable")
+        return list(self.parts.values())
+
+    def start(self):
+        """Start the background task that keeps the snapshot fresh"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sync(self):
+        try:
+            await self._watch()
+        except OperationFailure as e:
+            # Change streams need a replica set or sharded cluster
+            print(f"Change streams unavailable ({e}), polling parts every {self.poll_interval}s")
+            await self._poll()
+
+    async def _watch(self):
+        self.mode = "change_stream"
+        resume_token = None
+        while True:
+            try:
+                async with parts_collection.watch(
+                    full_document="updateLookup", resume_after=resume_token, max_await_time_ms=1000
+                ) as stream:
+                    while stream.alive:
+                        change = await stream.try_next()
+                        self.last_synced_at = datetime.now()
+                        if change is None:
+                            continue
+                        resume_token = stream.resume_token
+                        self._apply_change(change)
+            except OperationFailure:
+                if resume_token is None:
+                    raise
+                # Resume point fell off the oplog, so start over from a fresh load
+                resume_token = None
+                await self.load()
+            except PyMongoError as e:
+                print(f"Inventory change stream error: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    def _apply_change(self, change):
+        operation = change.get("operationType")
+        if operation in ("insert", "update", "replace"):
+            if change.get("fullDocument"):
+                self.upsert(change["fullDocument"])
+            else:
+                # Document was deleted before the update could be looked up
+                self.remove(change["documentKey"]["_id"])
+        elif operation == "delete":
+            self.remove(change["documentKey"]["_id"])
+        elif operation in ("drop", "rename", "invalidate"):
+            self.parts = {}
+            parts_index.rebuild([])
+            part_number_index.rebuild([])
+            self.version += 1
+
+    async def _poll(self):
+        self.mode = "polling"
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                query = {}
+                if self._watermark is not None:
+                    since = self._watermark - self.poll_overlap
+                    query = {"$or": [
+                        {"updated_at": {"$gte": since}},
+                        {"created_at": {"$gte": since}}
+                    ]}
+                async for part in parts_collection.find(query):
+                    known = self.parts.get(str(part["_id"]))
+                    if known != part:
+                        self.upsert(part)
+                # Deletions leave nothing to query for, so diff ids when the count disagrees
+                if await parts_collection.estimated_document_count() != len(self.parts):
+                    ids = {str(doc["_id"]) async for doc in parts_collection.find({}, {"_id": 1})}
+                    for part_id in set(self.parts) - ids:
+                        self.remove(part_id)
+                self.last_synced_at = datetime.now()
+            except PyMongoError as e:
+                print(f"Inventory snapshot poll error: {e}")
+
+    def stats(self):
+        staleness = None
+        if self.last_synced_at:
+            staleness = (datetime.now() - self.last_synced_at).total_seconds()
+        lookups = self.hits + self.misses
+        return {
+            "loaded": self.loaded,
+            "mode": self.mode,
+            "version": self.version,
+            "parts": len(self.parts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "changes_applied": self.changes_applied,
+            "staleness_seconds": staleness,
+        }
+
+inventory_snapshot = InventorySnapshot(
+    poll_interval=float(os.getenv('INVENTORY_POLL_SECONDS', '5')),
+    poll_overlap=float(os.getenv('INVENTORY_POLL_OVERLAP_SECONDS', '10'))
+)
+
+def serialize_part(part):
+    """JSON-safe summary of a part for API responses"""
+    return {
+        'id': str(part['_id']),
+        'part_number': part.get('part_number'),
+        'part_name': part.get('part_name'),
+        'brand': part.get('brand'),
+        'vehicle_compatibility': part.get('vehicle_compatibility'),
+        'category': part.get('category'),
+        'quantity_in_stock': part.get('quantity_in_stock'),
+        'minimum_stock_level': part.get('minimum_stock_level'),
+        'unit_price': part.get('unit_price'),
+        'supplier': part.get('supplier'),
+        'location_in_shop': part.get('location_in_shop'),
+        'image_filename': part.get('image_filename')
+    }
+
+def format_part_context(part):
+    """One prompt line describing a part"""
+    return (
+        f"- {part.get('part_name')} (Part #: {part.get('part_number')}, Brand: {part.get('brand')}, "
+        f"Compatibility: {part.get('vehicle_compatibility')}, Category: {part.get('category')}, "
+        f"Stock: {part.get('quantity_in_stock')}, Min Stock: {part.get('minimum_stock_level')}, "
+        f"Price: ${part.get('unit_price')}, Supplier: {part.get('supplier')})\n"
+    )
+
+def select_context_parts(user_message, top_k=CHAT_CONTEXT_TOP_K):
+    """Parts relevant to a chat message, and whether they matched it directly"""
+    parts = parts_index.search(user_message, top_k)
+    if parts:
+        return parts, True
+    # Nothing matched by name, so fall back to the parts most in need of attention
+    return parts_index.low_stock(top_k), False
+
+def build_inventory_context(parts, matched):
+    """Format the selected parts and a catalogue summary for the system prompt"""
+    context = (
+        f"Catalogue summary: {len(parts_index)} parts in total, "
+        f"{len(parts_index.low_stock_ids)} below minimum stock.\n"
+    )
+    if matched:
+        context += f"Inventory data (the {len(parts)} parts most relevant to the question):\n"
+    else:
+        context += f"Inventory data (no direct match, showing the {len(parts)} parts lowest against minimum stock):\n"
+    for part in parts:
+        context += format_part_context(part)
+    return context
+
 # Routes
 @app.get('/test-static')
 async def test_static():
     return {"message": "Static files should be working", "static_dir": STATIC_DIR}
 
+PARTS_PAGE_SIZE = 50
+
+async def list_parts_page(category=None, brand=None, low_stock=False, after=None, before=None, limit=PARTS_PAGE_SIZE):
+    """One page of parts ordered by part_number, using keyset cursors instead of skip.
+
+    after/before are the part numbers at the edges of the neighbouring page.
+    Returns (parts, next_cursor, prev_cursor); a cursor is None when there is
+    no page in that direction.
+    """
+    query = {}
+    if category:
+        query["category"] = category
+    if brand:
+        query["brand"] = brand
+    if low_stock:
+        query["is_low_stock"] = True
+    
+    if before:
+        query["part_number"] = {"$lt": before}
+        parts = await parts_collection.find(query).sort("part_number", DESCENDING).limit(limit + 1).to_list(limit + 1)
+        has_previous = len(parts) > limit
+        parts = parts[:limit][::-1]
+        next_cursor = parts[-1]["part_number"] if parts else None
+        prev_cursor = parts[0]["part_number"] if has_previous else None
+    else:
+        if after:
+            query["part_number"] = {"$gt": after}
+        parts = await parts_collection.find(query).sort("part_number", ASCENDING).limit(limit + 1).to_list(limit + 1)
+        has_next = len(parts) > limit
+        parts = parts[:limit]
+        next_cursor = parts[-1]["part_number"] if has_next else None
+        prev_cursor = parts[0]["part_number"] if after and parts else None
+    return parts, next_cursor, prev_cursor
+
+async def part_filter_options():
+    """Distinct categories and brands for the inventory filters"""
+    if inventory_snapshot.loaded:
+        parts = inventory_snapshot.parts.values()
+        categories = {part.get("category") for part in parts}
+        brands = {part.get("brand") for part in parts}
+    else:
+        categories = set(await parts_collection.distinct("category"))
+        brands = set(await parts_collection.distinct("brand"))
+    return sorted(c for c in categories if c), sorted(b for b in brands if b)
+
 @app.get('/', response_class=HTMLResponse)
-async def home(request: Request):
+async def home(
+    request: Request,
+    category: Optional[str] = None,
+    brand: Optional[str] = None,
+    low_stock: bool = False,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    q: Optional[str] = None
+):
+    q = (q or '').strip()
+    filters = {'category': category or '', 'brand': brand or '', 'low_stock': low_stock, 'q': q}
     try:
-        parts = await parts_collection.find().to_list(1000)
-        return templates.TemplateResponse('index.html', {'request': request, 'parts': parts})
+        if q:
+            # A search covers the whole inventory, best matches first, on one page
+            parts, next_cursor, prev_cursor = await search_parts_ranked(q, PARTS_PAGE_SIZE), None, None
+        else:
+            parts, next_cursor, prev_cursor = await list_parts_page(category, brand, low_stock, after, before)
+        categories, brands = await part_filter_options()
+        return templates.TemplateResponse('index.html', {
+            'request': request,
+            'parts': parts,
+            'filters': filters,
+            'categories': categories,
+            'brands': brands,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
+        })
     except Exception as e:
         print(f"Error loading home page: {e}")
-        return templates.TemplateResponse('index.html', {'request': request, 'parts': [], 'error': 'Database connection error'})
+        return templates.TemplateResponse('index.html', {
+            'request': request,
+            'parts': [],
+            'filters': filters,
+            'categories': [],
+            'brands': [],
+            'error': 'Database connection error'
+        })
+
+@app.get('/api/parts')
+async def list_parts_api(
+    category: Optional[str] = None,
+    brand: Optional[str] = None,
+    low_stock: bool = False,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = PARTS_PAGE_SIZE
+):
+    """Paginated, filtered parts list; pass next_cursor as after (or prev_cursor as before)"""
+    try:
+        limit = max(1, min(limit, 200))
+        parts, next_cursor, prev_cursor = await list_parts_page(category, brand, low_stock, after, before, limit)
+        return JSONResponse({
+            'parts': [serialize_part(part) for part in parts],
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
+        })
+    except Exception as e:
+        print(f"Error listing parts: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
 
 @app.get('/add', response_class=HTMLResponse)
 async def add_part_page(request: Request):
@@ -312,9 +1616,11 @@ async def add_part(
             "part_name": part_name,
             "brand": brand,
             "vehicle_compatibility": vehicle_compatibility,
+            "vehicles": parse_vehicle_compatibility(vehicle_compatibility),
             "category": category,
             "quantity_in_stock": quantity_in_stock,
             "minimum_stock_level": minimum_stock_level,
+            **low_stock_fields(quantity_in_stock, minimum_stock_level),
             "unit_price": unit_price,
             "supplier": supplier,
             "location_in_shop": location_in_shop,
@@ -325,6 +1631,7 @@ async def add_part(
         }
         
         await parts_collection.insert_one(part_data)
+        inventory_snapshot.upsert(part_data)
         return RedirectResponse(url='/', status_code=303)
     except Exception as e:
         print(f"Error adding part: {e}")
@@ -385,9 +1692,11 @@ async def edit_part(
             "part_name": part_name,
             "brand": brand,
             "vehicle_compatibility": vehicle_compatibility,
+            "vehicles": parse_vehicle_compatibility(vehicle_compatibility),
             "category": category,
             "quantity_in_stock": quantity_in_stock,
             "minimum_stock_level": minimum_stock_level,
+            **low_stock_fields(quantity_in_stock, minimum_stock_level),
             "unit_price": unit_price,
             "supplier": supplier,
             "location_in_shop": location_in_shop,
@@ -401,6 +1710,9 @@ async def edit_part(
             part_data["image_filename"] = image_filename
         
         await parts_collection.update_one({"_id": ObjectId(part_id)}, {"$set": part_data})
+        updated_part = await on_primary(parts_collection).find_one({"_id": ObjectId(part_id)})
+        if updated_part:
+            inventory_snapshot.upsert(updated_part)
         return RedirectResponse(url='/', status_code=303)
     except Exception as e:
         print(f"Error editing part: {e}")
@@ -409,6 +1721,7 @@ async def edit_part(
 @app.get('/delete/{part_id}')
 async def delete_part(part_id: str):
     await parts_collection.delete_one({"_id": ObjectId(part_id)})
+    inventory_snapshot.remove(part_id)
     return RedirectResponse(url='/', status_code=303)
 
 @app.get('/login', response_class=HTMLResponse)
@@ -430,7 +1743,8 @@ async def login(
     
     access_token = create_access_token(data={"sub": username, "role": user["role"]})
     response = RedirectResponse(url='/', status_code=303)
-    response.set_cookie(key="access_token", value=access_token, httponly=True)
+    # SameSite=Lax keeps other sites from making cookie-authenticated POSTs to the admin endpoints
+    response.set_cookie(key="access_token", value=access_token, httponly=True, samesite="lax")
     return response
 
 @app.get('/logout')
@@ -439,115 +1753,451 @@ async def logout():
     response.delete_cookie(key="access_token")
     return response
 
+@app.post('/api/users/{username}')
+async def update_user(username: str, request: Request, current_user = Depends(get_current_admin_user)):
+    """Change a user's role or active flag (admin only)"""
+    data = await request.json()
+    changes = {}
+    if 'role' in data:
+        if data['role'] not in ('admin', 'worker'):
+            return JSONResponse({'error': 'role must be admin or worker'}, status_code=400)
+        changes['role'] = data['role']
+    if 'is_active' in data:
+        changes['is_active'] = bool(data['is_active'])
+    if not changes:
+        return JSONResponse({'error': 'Nothing to update'}, status_code=400)
+    
+    result = await users_collection.update_one({"username": username}, {"$set": changes})
+    user_cache.invalidate(username)
+    if result.matched_count == 0:
+        return JSONResponse({'error': 'User not found'}, status_code=404)
+    return JSONResponse({'success': True, 'username': username, **changes})
+
 @app.get('/chat', response_class=HTMLResponse)
 async def chat_page(request: Request):
     return templates.TemplateResponse('chat.html', {'request': request})
 
+# ==================== LLM CLIENT ====================
+
+# Errors worth retrying: the request never reached the model or the service was overloaded
+LLM_RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError, asyncio.TimeoutError)
+
+class LLMLimiter:
+    """Bounds concurrent LLM calls and records how long callers wait for a slot"""
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.calls = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.total_wait_seconds = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
+        started = datetime.now()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.total_wait_seconds += (datetime.now() - started).total_seconds()
+        self.in_flight += 1
+        self.calls += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "avg_wait_seconds": round(self.total_wait_seconds / self.calls, 4) if self.calls else None,
+        }
+
+llm_limiter = LLMLimiter(OPENAI_MAX_CONCURRENCY)
+
+async def complete_chat(messages, stream=False, max_tokens=500):
+    """Call the chat completions API with a timeout and exponential backoff retries.
+
+    Must be called while holding an llm_limiter slot. With stream=True the
+    returned object is an async iterator of chunks; retries only cover
+    opening the stream.
+    """
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            return await asyncio.wait_for(
+                openai_client.chat.completions.create(
+                    model=OPENAI_MODEL,
+                    messages=messages,  # type: ignore
+                    max_tokens=max_tokens,
+                    stream=stream
+                ),
+                timeout=OPENAI_TIMEOUT_SECONDS
+            )
+        except LLM_RETRYABLE_ERRORS as e:
+            if isinstance(e, (APITimeoutError, asyncio.TimeoutError)):
+                llm_limiter.timeouts += 1
+            if attempt == OPENAI_MAX_RETRIES:
+                llm_limiter.failures += 1
+                raise
+            llm_limiter.retries += 1
+            delay = min(8.0, 0.5 * 2 ** attempt) + random.uniform(0, 0.25)
+            print(f"LLM call failed ({e.__class__.__name__}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+# ==================== CHAT RESPONSE CACHE ====================
+
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', '500'))
+CHAT_CACHE_TTL_SECONDS = float(os.getenv('CHAT_CACHE_TTL_SECONDS', '600'))
+# Optional sentence-transformers model name for matching reworded questions, e.g. all-MiniLM-L6-v2
+CHAT_CACHE_EMBEDDING_MODEL = os.getenv('CHAT_CACHE_EMBEDDING_MODEL', '')
+CHAT_CACHE_SIMILARITY = float(os.getenv('CHAT_CACHE_SIMILARITY', '0.92'))
+
+# Words that point back at earlier turns, making the answer depend on history
+FOLLOW_UP_WORDS = {"it", "its", "that", "those", "them", "they", "this", "these", "same", "one", "ones"}
+
+def normalize_question(text):
+    """Question with case, punctuation and spacing folded; word order and question words are kept,
+    since "how many" and "show all", or "Honda but not Toyota" and the reverse, need different answers"""
+    return " ".join(re.findall(r'[a-z0-9]+', str(text or "").lower()))
+
+def is_cacheable_question(session, user_message):
+    """A cached answer is only safe when the question stands on its own"""
+    if not session.get("messages"):
+        return True
+    words = set(re.findall(r'[a-z]+', user_message.lower()))
+    return not (words & FOLLOW_UP_WORDS)
+
+def context_fingerprint(parts):
+    """Hash of the part data an answer was based on; changes when any of those parts change"""
+    lines = "".join(format_part_context(part) for part in parts)
+    return hashlib.sha1(lines.encode()).hexdigest()
+
+class ChatResponseCache:
+    """TTL + LRU cache of assistant answers.
+
+    Entries are keyed on the normalized question and the fingerprint of the
+    parts that were put in the prompt, so an answer is only reused while the
+    inventory it quoted is unchanged. Changes to a part also evict every entry
+    that quoted it. With an embedding model configured, a reworded question
+    can reuse an answer given for the same parts if the questions are similar
+    enough.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, embedding_model_name="", similarity=0.92):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embedding_model_name = embedding_model_name
+        self.similarity = similarity
+        self.entries = OrderedDict()
+        self.keys_by_part = defaultdict(set)
+        self._embedding_model = None
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def make_key(self, user_message, parts):
+        return (normalize_question(user_message), context_fingerprint(parts))
+
+    async def _embed(self, text):
+        if not self.embedding_model_name:
+            return None
+        if self._embedding_model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                print("sentence-transformers is not installed, semantic chat cache disabled")
+                self.embedding_model_name = ""
+                return None
+            self._embedding_model = await asyncio.to_thread(SentenceTransformer, self.embedding_model_name)
+        return await asyncio.to_thread(self._embedding_model.encode, text, normalize_embeddings=True)
+
+    def _expired(self, entry):
+        return (datetime.now() - entry["created_at"]).total_seconds() > self.ttl_seconds
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            for part_id in entry["part_ids"]:
+                keys = self.keys_by_part.get(part_id)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.keys_by_part[part_id]
+
+    async def get(self, key, user_message):
+        """Cached answer for the key, or for a similar question over the same parts"""
+        entry = self.entries.get(key)
+        if entry and self._expired(entry):
+            self._drop(key)
+            entry = None
+        if entry:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry["response"]
+        
+        if self.embedding_model_name:
+            embedding = await self._embed(user_message)
+            if embedding is not None:
+                best_key, best_score = None, self.similarity
+                for other_key, other in self.entries.items():
+                    if other_key[1] != key[1] or other["embedding"] is None or self._expired(other):
+                        continue
+                    score = float(embedding @ other["embedding"])
+                    if score >= best_score:
+                        best_key, best_score = other_key, score
+                if best_key is not None:
+                    self.entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    return self.entries[best_key]["response"]
+        
+        self.misses += 1
+        return None
+
+    async def put(self, key, user_message, parts, response):
+        embedding = await self._embed(user_message)
+        self._drop(key)
+        part_ids = {str(part["_id"]) for part in parts}
+        self.entries[key] = {
+            "response": response,
+            "part_ids": part_ids,
+            "embedding": embedding,
+            "created_at": datetime.now()
+        }
+        for part_id in part_ids:
+            self.keys_by_part[part_id].add(key)
+        while len(self.entries) > self.max_entries:
+            oldest_key = next(iter(self.entries))
+            self._drop(oldest_key)
+            self.evictions += 1
+
+    def invalidate_part(self, part_id):
+        """Evict every answer that quoted the given part"""
+        for key in list(self.keys_by_part.get(str(part_id), ())):
+            self._drop(key)
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "semantic_matching": bool(self.embedding_model_name),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.semantic_hits) / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+chat_response_cache = ChatResponseCache(
+    CHAT_CACHE_SIZE,
+    CHAT_CACHE_TTL_SECONDS,
+    embedding_model_name=CHAT_CACHE_EMBEDDING_MODEL,
+    similarity=CHAT_CACHE_SIMILARITY
+)
+
+# Messages kept per session, and how many of the latest are sent to the model as history
+CHAT_SESSION_MAX_MESSAGES = 100
+CHAT_HISTORY_WINDOW = 10
+
+async def get_chat_session(session_id):
+    """Get or create a chat session, fetching only the recent history window"""
+    now = datetime.now()
+    return await chat_sessions_collection.find_one_and_update(
+        {"session_id": session_id},
+        {"$setOnInsert": {
+            "session_id": session_id,
+            "messages": [],
+            "created_at": now,
+            "last_updated": now
+        }},
+        projection={"messages": {"$slice": -CHAT_HISTORY_WINDOW}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+def build_chat_messages(session, user_message, inventory_context):
+    """System prompt with relevant inventory, recent history and the new question"""
+    # Create system message
+    system_message = f"""You are an AI assistant for SLN AUTOMOBILES spare parts shop. 
+    You have access to the following inventory data, selected from the full catalogue as the parts relevant to the question. Answer questions about parts, availability, pricing, and compatibility.
+    Be helpful and provide accurate information based on the data provided.
+    
+    {inventory_context}"""
+    
+    # Build conversation history
+    messages = [{"role": "system", "content": system_message}]
+    
+    # Add previous messages (limit to the last few for context)
+    for msg in session.get("messages", [])[-CHAT_HISTORY_WINDOW:]:
+        if msg.get("role") in ("user", "assistant") and "content" in msg:
+            messages.append({"role": msg["role"], "content": msg["content"]})
+    
+    # Add current user message
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+def chat_unavailable_message():
+    return f"AI Assistant is currently unavailable. However, I can see you have {len(parts_index)} parts in your inventory. Please contact support to enable AI features."
+
+async def save_chat_turn(session, user_message, ai_response):
+    """Atomically append a question/answer pair, keeping only the latest messages"""
+    now = datetime.now()
+    await chat_sessions_collection.update_one(
+        {"session_id": session["session_id"]},
+        {
+            "$push": {
+                "messages": {
+                    "$each": [
+                        {"role": "user", "content": user_message, "timestamp": now},
+                        {"role": "assistant", "content": ai_response, "timestamp": now}
+                    ],
+                    "$slice": -CHAT_SESSION_MAX_MESSAGES
+                }
+            },
+            "$set": {"last_updated": now}
+        }
+    )
+
 @app.post('/api/chat')
 async def chat_api(request: Request):
     try:
         data = await request.json()
         user_message = data.get('message', '')
-        language = data.get('language', 'en-US')
         session_id = data.get('session_id', str(uuid.uuid4()))
         
-        # Get or create chat session
-        session = await chat_sessions_collection.find_one({"session_id": session_id})
-        if not session:
-            session = {
-                "session_id": session_id,
-                "messages": [],
-                "created_at": datetime.now(),
-                "last_updated": datetime.now()
-            }
-            await chat_sessions_collection.insert_one(session)
+        session = await get_chat_session(session_id)
         
-        # Get inventory data for context
-        parts = await parts_collection.find().to_list(1000)
-        inventory_context = "Inventory data:\n"
-        for part in parts:
-            inventory_context += f"- {part['part_name']} (Part #: {part['part_number']}, Brand: {part['brand']}, "
-            inventory_context += f"Compatibility: {part['vehicle_compatibility']}, Category: {part['category']}, "
-            inventory_context += f"Stock: {part['quantity_in_stock']}, Min Stock: {part['minimum_stock_level']}, "
-            inventory_context += f"Price: ${part['unit_price']}, Supplier: {part['supplier']})\n"
+        # Make sure the inventory used for context is loaded
+        await inventory_snapshot.get_parts()
         
         # Check if OpenAI client is available
         if not openai_client:
             return JSONResponse({
-                'response': f"AI Assistant is currently unavailable. However, I can see you have {len(parts)} parts in your inventory. Please contact support to enable AI features.",
+                'response': chat_unavailable_message(),
                 'session_id': session_id
             })
         
-        # Create system message
-        system_message = f"""You are an AI assistant for SLN AUTOMOBILES spare parts shop. 
-        You have access to the following inventory data. Answer questions about parts, availability, pricing, and compatibility.
-        Be helpful and provide accurate information based on the data provided.
-        
-        {inventory_context}"""
-        
-        # Build conversation history
-        messages = [{"role": "system", "content": system_message}]
+        parts, matched = select_context_parts(user_message)
+        cache_key = None
+        if is_cacheable_question(session, user_message):
+            cache_key = chat_response_cache.make_key(user_message, parts)
+            cached_response = await chat_response_cache.get(cache_key, user_message)
+            if cached_response is not None:
+                await save_chat_turn(session, user_message, cached_response)
+                return JSONResponse({
+                    'response': cached_response,
+                    'session_id': session_id,
+                    'cached': True
+                })
         
-        # Add previous messages (limit to last 10 for context)
-        for msg in session.get("messages", [])[-10:]:
-            if "role" in msg and "content" in msg:
-                messages.append({"role": msg["role"], "content": msg["content"]})
-        
-        # Add current user message
-        messages.append({"role": "user", "content": user_message})
-        
-        # Convert to proper format for OpenAI
-        openai_messages = []
-        for msg in messages:
-            if msg["role"] == "system":
-                openai_messages.append({"role": "system", "content": msg["content"]})
-            elif msg["role"] == "user":
-                openai_messages.append({"role": "user", "content": msg["content"]})
-            elif msg["role"] == "assistant":
-                openai_messages.append({"role": "assistant", "content": msg["content"]})
+        messages = build_chat_messages(session, user_message, build_inventory_context(parts, matched))
         
         # Get response from OpenAI
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,  # type: ignore
-            max_tokens=500
-        )
+        async with llm_limiter.slot():
+            response = await complete_chat(messages)
         
         ai_response = response.choices[0].message.content
         
-        # Save messages to session
-        session_messages = session.get("messages", [])
-        session_messages.append({"role": "user", "content": user_message, "timestamp": datetime.now()})
-        session_messages.append({"role": "assistant", "content": ai_response, "timestamp": datetime.now()})
+        await save_chat_turn(session, user_message, ai_response)
+        if cache_key and ai_response:
+            await chat_response_cache.put(cache_key, user_message, parts, ai_response)
         
-        # Keep only last 100 messages
-        if len(session_messages) > 100:
-            session_messages = session_messages[-100:]
+        return JSONResponse({
+            'response': ai_response,
+            'session_id': session_id
+        })
         
-        # Update session
-        await chat_sessions_collection.update_one(
-            {"session_id": session_id},
-            {
-                "$set": {
-                    "messages": session_messages,
-                    "last_updated": datetime.now()
-                }
-            }
-        )
-        
-        return JSONResponse({
-            'response': ai_response,
-            'session_id': session_id
-        })
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+def sse_event(payload):
+    """Format a payload as a server-sent event"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+@app.post('/api/chat/stream')
+async def chat_stream_api(request: Request):
+    """Chat API that streams tokens as server-sent events while they are generated"""
+    try:
+        data = await request.json()
+        user_message = data.get('message', '')
+        session_id = data.get('session_id', str(uuid.uuid4()))
         
+        session = await get_chat_session(session_id)
+        await inventory_snapshot.get_parts()
     except Exception as e:
         return JSONResponse({'error': str(e)}, status_code=500)
+    
+    async def event_stream():
+        yield sse_event({'session_id': session_id})
+        
+        if not openai_client:
+            yield sse_event({'token': chat_unavailable_message()})
+            yield sse_event({'done': True})
+            return
+        
+        try:
+            parts, matched = select_context_parts(user_message)
+            cache_key = None
+            if is_cacheable_question(session, user_message):
+                cache_key = chat_response_cache.make_key(user_message, parts)
+                cached_response = await chat_response_cache.get(cache_key, user_message)
+                if cached_response is not None:
+                    yield sse_event({'token': cached_response, 'cached': True})
+                    await save_chat_turn(session, user_message, cached_response)
+                    yield sse_event({'done': True})
+                    return
+            
+            messages = build_chat_messages(session, user_message, build_inventory_context(parts, matched))
+            tokens = []
+            async with llm_limiter.slot():
+                stream = await complete_chat(messages, stream=True)
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    token = chunk.choices[0].delta.content
+                    if token:
+                        tokens.append(token)
+                        yield sse_event({'token': token})
+            
+            # Persist the completed turn once the whole answer has been sent
+            ai_response = "".join(tokens)
+            await save_chat_turn(session, user_message, ai_response)
+            if cache_key and ai_response:
+                await chat_response_cache.put(cache_key, user_message, parts, ai_response)
+            yield sse_event({'done': True})
+        except Exception as e:
+            print(f"Chat stream error: {e}")
+            yield sse_event({'error': str(e)})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get('/dashboard', response_class=HTMLResponse)
 async def dashboard(request: Request):
     # Get statistics
     total_parts = await parts_collection.count_documents({})
-    low_stock_parts = await parts_collection.count_documents({"$expr": {"$lt": ["$quantity_in_stock", "$minimum_stock_level"]}})
+    # Both low-stock queries are served by the partial low_stock_shortfall index
+    low_stock_parts = await parts_collection.count_documents({"is_low_stock": True})
     
     # Get total inventory value
     pipeline = [
@@ -564,10 +2214,8 @@ async def dashboard(request: Request):
     ]
     categories = await parts_collection.aggregate(category_pipeline).to_list(100)
     
-    # Get low stock items
-    low_stock_items = await parts_collection.find(
-        {"$expr": {"$lt": ["$quantity_in_stock", "$minimum_stock_level"]}}
-    ).to_list(100)
+    # Get low stock items, the furthest below their minimum first
+    low_stock_items = await parts_collection.find({"is_low_stock": True}).sort("shortfall", DESCENDING).to_list(100)
     
     return templates.TemplateResponse('dashboard.html', {
         'request': request,
@@ -578,47 +2226,673 @@ async def dashboard(request: Request):
         'low_stock_items': low_stock_items
     })
 
+# ==================== PART IMPORT ====================
+
+IMPORT_DIR = os.path.join(BASE_DIR, "uploads", "imports")
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '1000'))
+# Row errors kept on the job document; the count keeps going past this
+IMPORT_MAX_ERRORS = 500
+
+IMPORT_TEXT_FIELDS = ["part_name", "brand", "vehicle_compatibility", "category", "supplier", "location_in_shop", "condition"]
+IMPORT_INT_FIELDS = ["quantity_in_stock", "minimum_stock_level", "warranty_period"]
+IMPORT_FLOAT_FIELDS = ["unit_price"]
+IMPORT_MAX_INT = 2 ** 63 - 1
+# Filled in for new parts only, so a partial price list doesn't blank existing fields
+IMPORT_DEFAULTS = {
+    "brand": "",
+    "vehicle_compatibility": "",
+    "vehicles": [],
+    "category": "",
+    "quantity_in_stock": 0,
+    "minimum_stock_level": 0,
+    "unit_price": 0.0,
+    "supplier": "",
+    "location_in_shop": None,
+    "condition": "New",
+    "warranty_period": None,
+    "image_filename": None
+}
+
+def import_header(name):
+    return re.sub(r'[^a-z0-9]+', '_', str(name or "").strip().lower()).strip('_')
+
+def read_import_rows(path, file_type):
+    """Yield (row_number, {column: value}) from a CSV or XLSX file without loading it whole"""
+    if file_type == "xlsx":
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            headers = [import_header(cell) for cell in next(rows, [])]
+            for row_number, row in enumerate(rows, start=2):
+                if any(cell not in (None, "") for cell in row):
+                    yield row_number, dict(zip(headers, row))
+        finally:
+            workbook.close()
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            reader = csv.reader(f)
+            headers = [import_header(cell) for cell in next(reader, [])]
+            for row_number, row in enumerate(reader, start=2):
+                if any(cell.strip() for cell in row):
+                    yield row_number, dict(zip(headers, row))
+
+def validate_import_row(row):
+    """Turn one file row into the fields to $set, or raise ValueError"""
+    part_number = str(row.get("part_number") or "").strip()
+    if not part_number:
+        raise ValueError("part_number is required")
+    fields = {"part_number": part_number}
+    for field in IMPORT_TEXT_FIELDS:
+        value = row.get(field)
+        if value is not None and str(value).strip():
+            fields[field] = str(value).strip()
+    for field in IMPORT_INT_FIELDS:
+        value = row.get(field)
+        if value is not None and str(value).strip():
+            try:
+                number = float(value)
+            except ValueError:
+                number = math.nan
+            # "inf" would overflow int(), and BSON can't hold integers past 64 bits
+            if not math.isfinite(number) or abs(number) > IMPORT_MAX_INT:
+                raise ValueError(f"{field} must be a whole number, got {value!r}")
+            fields[field] = int(number)
+            if fields[field] < 0:
+                raise ValueError(f"{field} cannot be negative")
+    for field in IMPORT_FLOAT_FIELDS:
+        value = row.get(field)
+        if value is not None and str(value).strip():
+            try:
+                fields[field] = float(str(value).replace("$", "").replace(",", ""))
+            except ValueError:
+                raise ValueError(f"{field} must be a number, got {value!r}")
+            # NaN passes every comparison, so it would slip past the negative check below
+            if not math.isfinite(fields[field]):
+                raise ValueError(f"{field} must be a finite number, got {value!r}")
+            if fields[field] < 0:
+                raise ValueError(f"{field} cannot be negative")
+    if "vehicle_compatibility" in fields:
+        fields["vehicles"] = parse_vehicle_compatibility(fields["vehicle_compatibility"])
+    return fields
+
+def import_upsert(fields, now):
+    """Pipeline upsert so the low-stock flags are recomputed in the same write as the row"""
+    fields["updated_at"] = now
+    on_insert = {key: value for key, value in IMPORT_DEFAULTS.items() if key not in fields}
+    on_insert["created_at"] = now
+    if "part_name" not in fields:
+        on_insert["part_name"] = fields["part_number"]
+    # Pipelines can't use $setOnInsert, so defaults only fill fields the part doesn't have yet;
+    # values are wrapped in $literal so text starting with "$" isn't read as a field path
+    values = {key: {"$literal": value} for key, value in fields.items()}
+    values.update({key: {"$ifNull": [f"${key}", {"$literal": value}]} for key, value in on_insert.items()})
+    return UpdateOne({"part_number": fields["part_number"]}, [{"$set": values}, LOW_STOCK_STAGE], upsert=True)
+
+async def write_import_batch(rows):
+    """bulk_write one batch of (row_number, operation); returns (inserted, updated, errors)"""
+    try:
+        result = await parts_collection.bulk_write([operation for _, operation in rows], ordered=False)
+        return result.upserted_count, result.modified_count, []
+    except BulkWriteError as e:
+        details = e.details
+        errors = [
+            {"row": rows[error["index"]][0], "error": error.get("errmsg", "write failed")}
+            for error in details.get("writeErrors", [])
+        ]
+        return details.get("nUpserted", 0), details.get("nModified", 0), errors
+
+async def run_part_import(job):
+    """Job handler: upsert every valid row of the uploaded file by part_number, recording progress"""
+    job_id = job["_id"]
+    counts = {"rows": 0, "inserted": 0, "updated": 0, "failed": 0}
+    # A retry starts over; the upserts make re-applying rows harmless
+    await jobs_collection.update_one({"_id": job_id}, {"$set": {"progress": counts, "errors": []}})
+    rows = read_import_rows(job["path"], job["file_type"])
+    read = None
+    try:
+        while True:
+            # Parsing (openpyxl especially) is CPU work, so keep it off the event loop. The read
+            # is shielded so a cancelled job can wait for the thread to leave the generator
+            read = asyncio.ensure_future(asyncio.to_thread(list, itertools.islice(rows, IMPORT_BATCH_SIZE)))
+            chunk = await asyncio.shield(read)
+            if not chunk:
+                break
+            now = datetime.now()
+            errors = []
+            batch = []
+            for row_number, row in chunk:
+                try:
+                    batch.append((row_number, import_upsert(validate_import_row(row), now)))
+                except ValueError as e:
+                    errors.append({"row": row_number, "error": str(e)})
+            if batch:
+                inserted, updated, write_errors = await write_import_batch(batch)
+                counts["inserted"] += inserted
+                counts["updated"] += updated
+                errors.extend(write_errors)
+            counts["rows"] += len(chunk)
+            counts["failed"] += len(errors)
+            update = {"$set": {"progress": dict(counts), "updated_at": datetime.now()}}
+            if errors:
+                update["$push"] = {"errors": {"$each": errors, "$slice": IMPORT_MAX_ERRORS}}
+            await jobs_collection.update_one({"_id": job_id}, update)
+    finally:
+        if read is not None and not read.done():
+            await asyncio.wait({read})
+        rows.close()
+        if counts["inserted"] or counts["updated"]:
+            await inventory_snapshot.load()
+    return counts
+
+def remove_import_file(job):
+    """Delete an import's uploaded file once the job can no longer run again"""
+    try:
+        os.remove(job["path"])
+    except (KeyError, OSError):
+        pass
+
+@app.post('/api/parts/import', status_code=202)
+async def import_parts(file: UploadFile = File(...)):
+    """Queue a CSV/XLSX supplier file for import; poll /api/jobs/{job_id} for progress"""
+    extension = os.path.splitext(file.filename or "")[1].lower()
+    if extension not in (".csv", ".xlsx"):
+        return JSONResponse({'error': 'Upload a .csv or .xlsx file'}, status_code=400)
+    if extension == ".xlsx":
+        if importlib.util.find_spec("openpyxl") is None:
+            return JSONResponse({'error': 'Excel import requires openpyxl (pip install openpyxl)'}, status_code=400)
+    try:
+        os.makedirs(IMPORT_DIR, exist_ok=True)
+        path = os.path.join(IMPORT_DIR, f"{uuid.uuid4().hex}{extension}")
+        with open(path, "wb") as buffer:
+            while chunk := await file.read(1024 * 1024):
+                buffer.write(chunk)
+        
+        job_id = await job_queue.enqueue(
+            "part_import",
+            filename=file.filename,
+            path=path,
+            file_type=extension[1:],
+            progress={"rows": 0, "inserted": 0, "updated": 0, "failed": 0},
+            errors=[]
+        )
+        return JSONResponse({'success': True, 'job_id': str(job_id)}, status_code=202)
+    except Exception as e:
+        print(f"Error queueing part import: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+# ==================== EXPORTS ====================
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+# Column layout per dataset: (field, type). Fixed up front so rows can be
+# written as they come off the cursor without looking at the whole collection.
+EXPORT_DATASETS = {
+    "inventory": {
+        "collection": "parts",
+        "sort": [("part_number", ASCENDING)],
+        "date_field": "created_at",
+        "columns": [
+            ("_id", "str"), ("part_number", "str"), ("part_name", "str"), ("brand", "str"),
+            ("vehicle_compatibility", "str"), ("category", "str"), ("quantity_in_stock", "int"),
+            ("minimum_stock_level", "int"), ("unit_price", "float"), ("supplier", "str"),
+            ("location_in_shop", "str"), ("condition", "str"), ("warranty_period", "int"),
+            ("created_at", "datetime")
+        ]
+    },
+    "invoices": {
+        "collection": "invoices",
+        "sort": [("created_at", DESCENDING)],
+        "date_field": "created_at",
+        "columns": [
+            ("_id", "str"), ("invoice_number", "str"), ("customer_id", "str"), ("customer.name", "str"),
+            ("customer.phone", "str"), ("pricing_tier", "str"), ("item_count", "int"),
+            ("subtotal", "float"), ("tax_rate", "float"), ("tax_amount", "float"), ("total", "float"),
+            ("payment_method", "str"), ("status", "str"), ("notes", "str"), ("created_at", "datetime")
+        ]
+    },
+    "sales": {
+        "collection": "sales",
+        "sort": [("sold_at", DESCENDING)],
+        "date_field": "sold_at",
+        "columns": [
+            ("_id", "str"), ("invoice_id", "str"), ("part_id", "str"), ("part_number", "str"),
+            ("part_name", "str"), ("brand", "str"), ("category", "str"), ("quantity_sold", "int"), ("unit_price", "float"),
+            ("total_price", "float"), ("sold_at", "datetime")
+        ]
+    },
+    "expenses": {
+        "collection": "expenses",
+        "sort": [("date", DESCENDING)],
+        "date_field": "date",
+        "columns": [
+            ("_id", "str"), ("description", "str"), ("amount", "float"), ("category", "str"),
+            ("date", "datetime"), ("payment_method", "str"), ("notes", "str"), ("created_at", "datetime")
+        ]
+    }
+}
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+def export_value(value, kind):
+    """Coerce a document field to its export column type (None stays None)"""
+    if value is None or value == "":
+        return None
+    try:
+        if kind == "int":
+            return int(value)
+        if kind == "float":
+            return float(value)
+        if kind == "datetime":
+            return value if isinstance(value, datetime) else None
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+def export_field(doc, field):
+    """Value at a dotted path such as customer.name, None if any step is missing"""
+    for key in field.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+def export_row(doc, columns):
+    if "items" in doc and "item_count" not in doc:
+        doc["item_count"] = len(doc["items"])
+    return {field: export_value(export_field(doc, field), kind) for field, kind in columns}
+
+def json_default(value):
+    if isinstance(value, (ObjectId, datetime, date)):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+async def export_batches(dataset, start=None, end=None):
+    """Yield lists of documents straight off the cursor, EXPORT_BATCH_SIZE at a time"""
+    spec = EXPORT_DATASETS[dataset]
+    query = {}
+    if start or end:
+        query[spec["date_field"]] = {}
+        if start:
+            query[spec["date_field"]]["$gte"] = start
+        if end:
+            query[spec["date_field"]]["$lt"] = end
+    cursor = db[spec["collection"]].find(query).sort(spec["sort"]).batch_size(EXPORT_BATCH_SIZE)
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def stream_csv(dataset, start=None, end=None):
+    columns = EXPORT_DATASETS[dataset]["columns"]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([field for field, _ in columns])
+    async for batch in export_batches(dataset, start, end):
+        for doc in batch:
+            row = export_row(doc, columns)
+            writer.writerow(["" if row[field] is None else row[field] for field, _ in columns])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+async def stream_ndjson(dataset, start=None, end=None):
+    """Whole documents, one per line, including nested fields the CSV drops"""
+    async for batch in export_batches(dataset, start, end):
+        yield "".join(json.dumps(doc, default=json_default) + "\n" for doc in batch).encode()
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last drain"""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+async def stream_parquet(dataset, start=None, end=None):
+    """One Parquet row group per cursor batch, flushed as it is written"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    arrow_types = {"str": pa.string(), "int": pa.int64(), "float": pa.float64(), "datetime": pa.timestamp("ms")}
+    columns = EXPORT_DATASETS[dataset]["columns"]
+    schema = pa.schema([(field, arrow_types[kind]) for field, kind in columns])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        async for batch in export_batches(dataset, start, end):
+            table = pa.Table.from_pylist([export_row(doc, columns) for doc in batch], schema=schema)
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+EXPORT_STREAMS = {"csv": stream_csv, "ndjson": stream_ndjson, "parquet": stream_parquet}
+
 @app.get('/export')
 async def export_inventory():
-    parts = await parts_collection.find().to_list(1000)
-    
-    # Convert to DataFrame
-    df = pd.DataFrame(parts)
-    if not df.empty:
-        df['_id'] = df['_id'].astype(str)
-        df['created_at'] = df['created_at'].astype(str)
-    
-    # Create CSV
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
+    return await export_dataset("inventory")
+
+@app.get('/export/{dataset}')
+async def export_dataset(dataset: str, format: str = "csv", start: Optional[str] = None, end: Optional[str] = None):
+    """Stream inventory, invoices, sales or expenses as CSV, NDJSON or Parquet.
+
+    start/end (YYYY-MM-DD) limit the rows by the dataset's date field; end is exclusive.
+    """
+    if dataset not in EXPORT_DATASETS:
+        return JSONResponse({'error': f"Unknown dataset '{dataset}'"}, status_code=404)
+    if format not in EXPORT_STREAMS:
+        return JSONResponse({'error': f"Unsupported format '{format}', use csv, ndjson or parquet"}, status_code=400)
+    if format == "parquet":
+        if importlib.util.find_spec("pyarrow") is None:
+            return JSONResponse({'error': 'Parquet export requires pyarrow (pip install pyarrow)'}, status_code=400)
+    try:
+        start_date = datetime.strptime(start, "%Y-%m-%d") if start else None
+        end_date = datetime.strptime(end, "%Y-%m-%d") if end else None
+    except ValueError:
+        return JSONResponse({'error': 'start and end must be YYYY-MM-DD'}, status_code=400)
     
     return StreamingResponse(
-        io.BytesIO(output.getvalue().encode()),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=inventory.csv"}
+        EXPORT_STREAMS[format](dataset, start_date, end_date),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f"attachment; filename={dataset}.{format}"}
     )
 
+async def search_parts_ranked(q, limit):
+    """Best matching parts for typed text, from the in-memory index when it is loaded"""
+    if inventory_snapshot.loaded:
+        return parts_index.search_prefix(q, limit)
+    # Snapshot not available yet, so fall back to a database prefix query
+    pattern = "^" + re.escape(q)
+    return await parts_collection.find({
+        "$or": [
+            {"part_number": {"$regex": pattern, "$options": "i"}},
+            {"part_name": {"$regex": pattern, "$options": "i"}},
+            {"brand": {"$regex": pattern, "$options": "i"}}
+        ]
+    }).to_list(limit)
+
 @app.get('/api/search')
-async def search_parts(q: str):
+async def search_parts(q: str, limit: int = 20, customer_type: Optional[str] = None):
+    """Ranked typeahead search over part number, name, brand, compatibility, category and supplier"""
     try:
         if not q or len(q.strip()) < 2:
             return JSONResponse({'parts': []})
+        limit = max(1, min(limit, 100))
         
-        parts = await parts_collection.find({
-            "$or": [
-                {"part_name": {"$regex": q.strip(), "$options": "i"}},
-                {"part_number": {"$regex": q.strip(), "$options": "i"}},
-                {"brand": {"$regex": q.strip(), "$options": "i"}},
-                {"vehicle_compatibility": {"$regex": q.strip(), "$options": "i"}}
-            ]
-        }).to_list(100)
-        
-        return JSONResponse({'parts': parts})
+        parts = await search_parts_ranked(q.strip(), limit)
+        results = [serialize_part(part) for part in parts]
+        if customer_type:
+            for result, part in zip(results, parts):
+                result['final_price'] = pricing_engine.price(part, customer_type)['unit_price']
+        return JSONResponse({'parts': results})
     except Exception as e:
         print(f"Search error: {e}")
         return JSONResponse({'parts': [], 'error': 'Search failed'})
 
+@app.get('/api/parts/fits')
+async def parts_that_fit(make: str, model: Optional[str] = None, year: Optional[int] = None, limit: int = 100):
+    """Parts compatible with a vehicle, answered from the vehicles index"""
+    try:
+        if not make.strip():
+            return JSONResponse({'parts': []})
+        limit = max(1, min(limit, 500))
+        parts = await parts_collection.find(
+            {"vehicles": {"$elemMatch": vehicle_fit_filter(make, model, year)}}
+        ).sort("part_number", ASCENDING).to_list(limit)
+        return JSONResponse({'parts': [serialize_part(part) for part in parts]})
+    except Exception as e:
+        print(f"Vehicle fit lookup error: {e}")
+        return JSONResponse({'parts': [], 'error': 'Lookup failed'}, status_code=500)
+
+# ==================== PRICING ====================
+
+DEFAULT_TAX_RATE = 0.08
+# Tier of walk-in customers and of customers without a pricing_tier
+DEFAULT_PRICING_TIER = "regular"
+# How often each process checks pricing_rules for changes made by other workers
+PRICING_REFRESH_SECONDS = float(os.getenv('PRICING_REFRESH_SECONDS', '30'))
+
+DEFAULT_PRICING_RULES = [
+    {"kind": "tier", "tier": "wholesale", "discount": 0.15},
+    {"kind": "tier", "tier": "vip", "discount": 0.10},
+    {"kind": "tax", "rate": DEFAULT_TAX_RATE},
+]
+
+def pricing_fraction(data, field):
+    try:
+        value = float(data[field])
+    except KeyError:
+        raise ValueError(f"{data.get('kind')} rule needs {field}")
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be a number")
+    if not 0 <= value < 1:
+        raise ValueError(f"{field} must be a fraction between 0 and 1, e.g. 0.15")
+    return value
+
+def validate_pricing_rule(data):
+    """Normalize a pricing rule from the API, or raise ValueError.
+
+    kinds:
+      tier      {"tier", "discount"}                        discount for a customer tier
+      category  {"category", "discount", "tier"?}           discount on a category, optionally for one tier
+      brand     {"brand", "discount", "tier"?}              discount on a brand, optionally for one tier
+      quantity  {"min_quantity", "discount", "category"?}   extra discount from a quantity upward
+      tax       {"rate", "category"?}                       tax rate, the default when no category
+    """
+    kind = data.get("kind")
+    if kind not in ("tier", "category", "brand", "quantity", "tax"):
+        raise ValueError("kind must be one of tier, category, brand, quantity, tax")
+    rule = {"kind": kind}
+    if kind == "tax":
+        rule["rate"] = pricing_fraction(data, "rate")
+    else:
+        rule["discount"] = pricing_fraction(data, "discount")
+    
+    if kind == "tier":
+        if not str(data.get("tier") or "").strip():
+            raise ValueError("tier rule needs tier")
+        rule["tier"] = str(data["tier"]).strip().lower()
+    elif kind in ("category", "brand"):
+        if not str(data.get(kind) or "").strip():
+            raise ValueError(f"{kind} rule needs {kind}")
+        rule[kind] = str(data[kind]).strip()
+        if data.get("tier"):
+            rule["tier"] = str(data["tier"]).strip().lower()
+    elif kind == "quantity":
+        try:
+            rule["min_quantity"] = int(data["min_quantity"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("quantity rule needs a whole number min_quantity")
+        if rule["min_quantity"] < 2:
+            raise ValueError("min_quantity must be at least 2")
+    if kind in ("quantity", "tax") and data.get("category"):
+        rule["category"] = str(data["category"]).strip()
+    return rule
+
+class PricingEngine:
+    """Pricing rules from the pricing_rules collection compiled into dict lookups.
+
+    A quote is a handful of dict gets and one bisect: the best of the tier,
+    brand and category discounts applies, a quantity break comes on top, and
+    the tax rate is by category with a default. Rules are reloaded when this
+    process changes them and polled for changes made elsewhere.
+    """
+
+    def __init__(self, refresh_interval=30.0):
+        self.refresh_interval = refresh_interval
+        self.tier_discounts = {}
+        self.scoped_discounts = {}
+        self.quantity_breaks = {}
+        self.tax_rates = {None: DEFAULT_TAX_RATE}
+        self.rule_count = 0
+        self.version = 0
+        self.loaded_at = None
+        self.quotes = 0
+        self._fingerprint = None
+        self._task = None
+
+    def compile(self, rules):
+        tier_discounts = {}
+        # (field, lowercased value, tier or None) -> discount
+        scoped_discounts = {}
+        breaks = defaultdict(list)
+        tax_rates = {None: DEFAULT_TAX_RATE}
+        for rule in rules:
+            kind = rule.get("kind")
+            if kind == "tier":
+                tier_discounts[rule["tier"]] = rule["discount"]
+            elif kind in ("category", "brand"):
+                scoped_discounts[(kind, rule[kind].lower(), rule.get("tier"))] = rule["discount"]
+            elif kind == "quantity":
+                breaks[(rule.get("category") or "").lower() or None].append((rule["min_quantity"], rule["discount"]))
+            elif kind == "tax":
+                tax_rates[(rule.get("category") or "").lower() or None] = rule["rate"]
+        quantity_breaks = {}
+        for category, steps in breaks.items():
+            steps.sort()
+            quantity_breaks[category] = ([quantity for quantity, _ in steps], [discount for _, discount in steps])
+        
+        # Swap in whole tables so a quote never sees half-compiled rules
+        self.tier_discounts = tier_discounts
+        self.scoped_discounts = scoped_discounts
+        self.quantity_breaks = quantity_breaks
+        self.tax_rates = tax_rates
+        self.rule_count = len(rules)
+        self.version += 1
+        self.loaded_at = datetime.now()
+
+    async def _current_fingerprint(self):
+        latest = await pricing_rules_collection.find_one({}, {"updated_at": 1}, sort=[("updated_at", DESCENDING)])
+        count = await pricing_rules_collection.estimated_document_count()
+        return count, latest.get("updated_at") if latest else None
+
+    async def load(self):
+        try:
+            rules = await pricing_rules_collection.find().to_list(None)
+            self.compile(rules)
+            self._fingerprint = await self._current_fingerprint()
+        except PyMongoError as e:
+            print(f"Error loading pricing rules: {e}")
+
+    def price(self, part, tier="regular", quantity=1):
+        """Quote one line: list price, combined discount, unit price and tax rate"""
+        self.quotes += 1
+        list_price = float(part.get("unit_price") or 0)
+        category = (part.get("category") or "").lower()
+        brand = (part.get("brand") or "").lower()
+        discount = max(
+            self.tier_discounts.get(tier, 0.0),
+            self.scoped_discounts.get(("brand", brand, tier), 0.0),
+            self.scoped_discounts.get(("brand", brand, None), 0.0),
+            self.scoped_discounts.get(("category", category, tier), 0.0),
+            self.scoped_discounts.get(("category", category, None), 0.0)
+        )
+        quantity_discount = 0.0
+        breaks = self.quantity_breaks.get(category) or self.quantity_breaks.get(None)
+        if breaks:
+            step = bisect.bisect_right(breaks[0], quantity) - 1
+            if step >= 0:
+                quantity_discount = breaks[1][step]
+        multiplier = (1 - discount) * (1 - quantity_discount)
+        return {
+            "list_price": list_price,
+            "discount": round(1 - multiplier, 4),
+            "unit_price": round(list_price * multiplier, 2),
+            "tax_rate": self.tax_rates.get(category, self.tax_rates[None])
+        }
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                if await self._current_fingerprint() != self._fingerprint:
+                    await self.load()
+            except PyMongoError as e:
+                print(f"Pricing rules poll error: {e}")
+
+    def stats(self):
+        return {
+            "rules": self.rule_count,
+            "version": self.version,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "quotes": self.quotes,
+        }
+
+pricing_engine = PricingEngine(refresh_interval=PRICING_REFRESH_SECONDS)
+
+def serialize_pricing_rule(rule):
+    data = {key: value for key, value in rule.items() if key not in ("_id", "updated_at")}
+    data["id"] = str(rule["_id"])
+    return data
+
+@app.get('/api/pricing/rules')
+async def list_pricing_rules():
+    rules = await pricing_rules_collection.find().sort("kind", ASCENDING).to_list(None)
+    return JSONResponse({'rules': [serialize_pricing_rule(rule) for rule in rules], 'version': pricing_engine.version})
+
+@app.post('/api/pricing/rules')
+async def add_pricing_rule(request: Request, current_user = Depends(get_current_admin_user)):
+    """Add a pricing rule (admin only); see validate_pricing_rule for the rule kinds"""
+    try:
+        rule = validate_pricing_rule(await request.json())
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    rule["updated_at"] = datetime.now()
+    result = await pricing_rules_collection.insert_one(rule)
+    await pricing_engine.load()
+    rule["_id"] = result.inserted_id
+    return JSONResponse(serialize_pricing_rule(rule), status_code=201)
+
+@app.delete('/api/pricing/rules/{rule_id}')
+async def delete_pricing_rule(rule_id: str, current_user = Depends(get_current_admin_user)):
+    try:
+        result = await pricing_rules_collection.delete_one({"_id": ObjectId(rule_id)})
+    except InvalidId:
+        return JSONResponse({'error': 'Invalid rule id'}, status_code=400)
+    if result.deleted_count == 0:
+        return JSONResponse({'error': 'Rule not found'}, status_code=404)
+    await pricing_engine.load()
+    return JSONResponse({'success': True})
+
 # ==================== SALES & INVOICE MANAGEMENT ====================
 
 @app.get('/sales', response_class=HTMLResponse)
@@ -627,39 +2901,281 @@ async def sales_page(request: Request):
     customers = await customers_collection.find().to_list(100)
     return templates.TemplateResponse('sales.html', {'request': request, 'customers': customers})
 
+# Most part numbers accepted by one /api/search-part/batch call
+SEARCH_PART_BATCH_MAX = 200
+
+def find_part_by_number(part_number):
+    """Snapshot lookup ignoring case and punctuation, preferring the literal part number"""
+    candidates = [inventory_snapshot.parts[i] for i in sorted(part_number_index.exact(part_number))]
+    return next(
+        (c for c in candidates if c.get("part_number") == part_number),
+        candidates[0] if candidates else None
+    )
+
+async def parts_by_number(part_numbers):
+    """Parts keyed by the part number asked for, from the snapshot where it has them and one
+    $in query for the rest, since a part added on another worker may not be synced yet"""
+    found = {}
+    if inventory_snapshot.loaded:
+        found = {number: part for number in part_numbers if (part := find_part_by_number(number))}
+    missing = [number for number in part_numbers if number not in found]
+    if missing:
+        async for part in on_primary(parts_collection).find({"part_number": {"$in": missing}}):
+            found[part["part_number"]] = part
+    return found
+
+def priced_part(part, customer_type, quantity=1):
+    """Sales-page view of a part with its server-side price for the customer type"""
+    quote = pricing_engine.price(part, customer_type, quantity)
+    return {
+        'id': str(part['_id']),
+        'part_number': part['part_number'],
+        'part_name': part['part_name'],
+        'brand': part['brand'],
+        'unit_price': part['unit_price'],
+        'final_price': quote['unit_price'],
+        'discount': quote['discount'],
+        'tax_rate': quote['tax_rate'],
+        'quantity_in_stock': part['quantity_in_stock'],
+        'customer_type': customer_type
+    }
+
+def part_suggestions(part_number, customer_type):
+    suggestions = []
+    for part_id, distance in part_number_index.suggest(part_number):
+        part = inventory_snapshot.parts[part_id]
+        suggestion = serialize_part(part)
+        suggestion['distance'] = distance
+        suggestion['final_price'] = pricing_engine.price(part, customer_type)['unit_price']
+        suggestions.append(suggestion)
+    return suggestions
+
 @app.get('/api/search-part')
 async def search_part_by_barcode(part_number: str, customer_type: str = "regular"):
-    """Search part by barcode/part number for sales with dynamic pricing"""
+    """Search part by barcode/part number for sales with dynamic pricing.
+
+    Matching ignores case and punctuation, and when nothing matches the
+    response carries the closest part numbers as suggestions.
+    """
     try:
-        part = await parts_collection.find_one({"part_number": part_number})
+        part = (await parts_by_number([part_number])).get(part_number)
         if part:
-            # Calculate dynamic pricing based on customer type
-            base_price = part['unit_price']
-            if customer_type == "wholesale":
-                final_price = base_price * 0.85  # 15% discount for wholesale
-            elif customer_type == "vip":
-                final_price = base_price * 0.90  # 10% discount for VIP
-            else:
-                final_price = base_price  # Regular price
-            
+            return JSONResponse({'found': True, 'part': priced_part(part, customer_type)})
+        else:
             return JSONResponse({
-                'found': True,
-                'part': {
-                    'id': str(part['_id']),
-                    'part_number': part['part_number'],
-                    'part_name': part['part_name'],
-                    'brand': part['brand'],
-                    'unit_price': part['unit_price'],
-                    'final_price': round(final_price, 2),
-                    'quantity_in_stock': part['quantity_in_stock'],
-                    'customer_type': customer_type
-                }
+                'found': False,
+                'message': 'Part not found',
+                'suggestions': part_suggestions(part_number, customer_type)
             })
-        else:
-            return JSONResponse({'found': False, 'message': 'Part not found'})
     except Exception as e:
         return JSONResponse({'error': str(e)}, status_code=500)
 
+@app.post('/api/search-part/batch')
+async def search_parts_by_barcode_batch(request: Request):
+    """Look up and price many scanned part numbers in one call.
+
+    Body: {"part_numbers": [...] or "one per line", "customer_type": "regular"}.
+    Repeated part numbers are merged into one result with a quantity, and
+    priced at that quantity. Results keep the order of first appearance.
+    """
+    try:
+        data = await request.json()
+        customer_type = data.get('customer_type', 'regular')
+        part_numbers = data.get('part_numbers') or []
+        if isinstance(part_numbers, str):
+            part_numbers = re.split(r'[\s,;]+', part_numbers)
+        part_numbers = [str(number).strip() for number in part_numbers if str(number).strip()]
+        if not part_numbers:
+            return JSONResponse({'error': 'No part numbers given'}, status_code=400)
+        if len(part_numbers) > SEARCH_PART_BATCH_MAX:
+            return JSONResponse({'error': f'At most {SEARCH_PART_BATCH_MAX} part numbers per request'}, status_code=400)
+        
+        # Counter keeps first-appearance order
+        quantities = Counter(part_numbers)
+        found = await parts_by_number(list(quantities))
+        
+        results = []
+        for number, quantity in quantities.items():
+            part = found.get(number)
+            if part:
+                results.append({
+                    'part_number': number,
+                    'quantity': quantity,
+                    'found': True,
+                    'part': priced_part(part, customer_type, quantity)
+                })
+            else:
+                results.append({
+                    'part_number': number,
+                    'quantity': quantity,
+                    'found': False,
+                    'suggestions': part_suggestions(number, customer_type)
+                })
+        return JSONResponse({
+            'results': results,
+            'found': sum(1 for result in results if result['found']),
+            'missing': sum(1 for result in results if not result['found'])
+        })
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+class InsufficientStockError(Exception):
+    """Raised when a sale asks for more units than are in stock"""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        details = ", ".join(
+            f"{s['part_number']} (requested {s['requested']}, available {s['available']})" for s in shortages
+        )
+        super().__init__(f"Insufficient stock for {details}")
+
+def stock_reservation_ops(quantities, now, marker=None):
+    """Conditional decrements that only match when enough stock is left.
+
+    Pipeline updates, so is_low_stock and shortfall change in the same write as the stock.
+    """
+    ops = []
+    for part_id, quantity in quantities.items():
+        values = {"quantity_in_stock": {"$subtract": ["$quantity_in_stock", quantity]}, "updated_at": now}
+        if marker:
+            values["pending_sales"] = {"$setUnion": [{"$ifNull": ["$pending_sales", []]}, {"$literal": [marker]}]}
+        ops.append(UpdateOne(
+            {"_id": part_id, "quantity_in_stock": {"$gte": quantity}}, [{"$set": values}, LOW_STOCK_STAGE]
+        ))
+    return ops
+
+async def find_stock_shortages(quantities, part_numbers, session=None):
+    """Lines of a sale that cannot be covered by current stock"""
+    available = {}
+    async for part in on_primary(parts_collection).find(
+        {"_id": {"$in": list(quantities)}}, {"quantity_in_stock": 1}, session=session
+    ):
+        available[part["_id"]] = part.get("quantity_in_stock", 0)
+    return [
+        {"part_number": part_numbers[part_id], "requested": quantity, "available": available.get(part_id, 0)}
+        for part_id, quantity in quantities.items()
+        if available.get(part_id, 0) < quantity
+    ]
+
+async def release_reserved_stock(quantities, marker):
+    """Give back stock reserved under marker (used when transactions are unavailable)"""
+    now = datetime.now()
+    await parts_collection.bulk_write([
+        UpdateOne(
+            {"_id": part_id, "pending_sales": marker},
+            [
+                {"$set": {
+                    "quantity_in_stock": {"$add": ["$quantity_in_stock", quantity]},
+                    "pending_sales": {"$setDifference": ["$pending_sales", {"$literal": [marker]}]},
+                    "updated_at": now
+                }},
+                LOW_STOCK_STAGE
+            ]
+        )
+        for part_id, quantity in quantities.items()
+    ], ordered=False)
+
+async def record_sale(invoice_data, sales_records, quantities, part_numbers):
+    """Reserve stock for every line and write the invoice and sales lines.
+
+    Runs in a multi-document transaction when the deployment supports it;
+    with_transaction retries it when a concurrent sale causes a write conflict.
+    On a standalone server the reservation is tagged with the invoice number
+    so it can be undone if any line is short or a later write fails.
+    """
+    now = invoice_data["created_at"]
+    if SUPPORTS_TRANSACTIONS:
+        async def write_sale(session):
+            result = await parts_collection.bulk_write(
+                stock_reservation_ops(quantities, now), ordered=False, session=session
+            )
+            if result.matched_count < len(quantities):
+                raise InsufficientStockError(await find_stock_shortages(quantities, part_numbers, session=session))
+            await invoices_collection.insert_one(invoice_data, session=session)
+            await sales_collection.insert_many(sales_records, session=session)
+        
+        async with await client.start_session() as session:
+            await session.with_transaction(write_sale, read_preference=ReadPreference.PRIMARY)
+        # After the commit: every sale of the day touches this row, so inside the
+        # transaction it would make any two concurrent sales conflict
+        await increment_daily_rollup(now, sales_total=invoice_data["total"], invoice_count=1)
+        return
+    
+    marker = invoice_data["invoice_number"]
+    result = await parts_collection.bulk_write(stock_reservation_ops(quantities, now, marker), ordered=False)
+    if result.matched_count < len(quantities):
+        await release_reserved_stock(quantities, marker)
+        raise InsufficientStockError(await find_stock_shortages(quantities, part_numbers))
+    try:
+        await invoices_collection.insert_one(invoice_data)
+        await sales_collection.insert_many(sales_records)
+    except Exception:
+        # insert_many is ordered, so lines before the failing one may already be written
+        await sales_collection.delete_many({"invoice_id": str(invoice_data["_id"])})
+        await invoices_collection.delete_one({"_id": invoice_data["_id"]})
+        await release_reserved_stock(quantities, marker)
+        raise
+    await parts_collection.update_many(
+        {"_id": {"$in": list(quantities)}}, {"$pull": {"pending_sales": marker}}
+    )
+    await increment_daily_rollup(now, sales_total=invoice_data["total"], invoice_count=1)
+
+async def customers_by_id(customer_ids):
+    """Customers for a set of customer_ids in one $in query, keyed by customer_id"""
+    customer_ids = list({customer_id for customer_id in customer_ids if customer_id})
+    if not customer_ids:
+        return {}
+    customers = await customers_collection.find({"customer_id": {"$in": customer_ids}}).to_list(len(customer_ids))
+    return {customer["customer_id"]: customer for customer in customers}
+
+async def parts_by_id(part_ids):
+    """Parts keyed by string id, from the snapshot where it has them and one $in query for the rest.
+
+    Parts missing from the snapshot may just be newer than it (added on another
+    worker before the next sync), so they are looked up rather than dropped.
+    """
+    part_ids = {str(part_id) for part_id in part_ids}
+    found = {}
+    if inventory_snapshot.loaded:
+        found = {part_id: inventory_snapshot.parts[part_id] for part_id in part_ids if part_id in inventory_snapshot.parts}
+    missing = [ObjectId(part_id) for part_id in part_ids if part_id not in found]
+    if missing:
+        async for part in on_primary(parts_collection).find({"_id": {"$in": missing}}):
+            found[str(part["_id"])] = part
+    return found
+
+def customer_snapshot(customer):
+    """Customer details frozen onto an invoice at sale time"""
+    if not customer:
+        return None
+    return {
+        "customer_id": customer.get("customer_id"),
+        "name": customer.get("name"),
+        "email": customer.get("email"),
+        "phone": customer.get("phone"),
+        "address": customer.get("address")
+    }
+
+def invoice_line(part, part_id, quantity, quote, custom_price=None):
+    """Invoice item with the part's catalogue details and pricing as they were at sale time"""
+    unit_price = quote["unit_price"] if custom_price is None else custom_price
+    total_price = round(quantity * unit_price, 2)
+    return {
+        "part_id": str(part_id),
+        "part_number": part.get("part_number"),
+        "part_name": part.get("part_name"),
+        "brand": part.get("brand"),
+        "category": part.get("category"),
+        "quantity": quantity,
+        "list_price": quote["list_price"],
+        "discount": quote["discount"],
+        "unit_price": unit_price,
+        "price_override": custom_price is not None,
+        "total_price": total_price,
+        "tax_rate": quote["tax_rate"],
+        "tax_amount": round(total_price * quote["tax_rate"], 2)
+    }
+
 @app.post('/api/create-sale')
 async def create_sale(request: Request):
     """Create a new sale/invoice"""
@@ -668,25 +3184,86 @@ async def create_sale(request: Request):
         customer_id = data.get('customer_id')
         items = data.get('items', [])
         payment_method = data.get('payment_method', 'cash')
+        requested_tier = data.get('customer_type')
         notes = data.get('notes', '')
+        current_user = await current_user_or_none(request)
         
         if not items:
             return JSONResponse({'error': 'No items in sale'}, status_code=400)
         
+        # Validate lines and total the quantity per part
+        quantities = {}
+        part_numbers = {}
+        for item in items:
+            try:
+                part_id = ObjectId(item['part_id'])
+                quantity = int(item['quantity'])
+                custom_price = item.get('custom_price')
+                custom_price = None if custom_price in (None, '') else float(custom_price)
+            except (KeyError, TypeError, ValueError, InvalidId):
+                return JSONResponse({'error': f"Invalid sale line: {item.get('part_number', item)}"}, status_code=400)
+            if quantity <= 0:
+                return JSONResponse({'error': f"Quantity must be positive for {item.get('part_number')}"}, status_code=400)
+            if custom_price is not None and custom_price < 0:
+                return JSONResponse({'error': f"Custom price cannot be negative for {item.get('part_number')}"}, status_code=400)
+            if custom_price is not None and (current_user is None or current_user.get("role") != "admin"):
+                return JSONResponse({'error': 'Custom prices need an admin login'}, status_code=403)
+            quantities[part_id] = quantities.get(part_id, 0) + quantity
+            part_numbers[part_id] = item.get('part_number')
+        
+        # Freeze part and customer details onto the invoice so it never needs joins
+        parts = await parts_by_id(quantities)
+        missing = [part_numbers[part_id] or str(part_id) for part_id in quantities if str(part_id) not in parts]
+        if missing:
+            return JSONResponse({'error': f"Unknown parts: {', '.join(missing)}"}, status_code=400)
+        customer = None
+        if customer_id:
+            customer = (await customers_by_id([customer_id])).get(customer_id)
+            if customer is None:
+                return JSONResponse({'error': f"Unknown customer: {customer_id}"}, status_code=400)
+        
+        # The tier comes from the customer record; only signed-in staff may charge a different one
+        pricing_tier = (customer or {}).get("pricing_tier") or DEFAULT_PRICING_TIER
+        tier_chosen_by = "customer" if customer else "default"
+        if requested_tier and requested_tier != pricing_tier:
+            if current_user is None:
+                return JSONResponse({'error': 'Changing the pricing tier needs a staff login'}, status_code=403)
+            pricing_tier = requested_tier
+            tier_chosen_by = current_user["username"]
+        
+        # Prices come from the pricing rules, never from the browser; quantity
+        # breaks apply to the part's total quantity across lines
+        lines = []
+        for item in items:
+            part_id = ObjectId(item['part_id'])
+            part = parts[str(part_id)]
+            quote = pricing_engine.price(part, pricing_tier, quantities[part_id])
+            custom_price = item.get('custom_price')
+            custom_price = None if custom_price in (None, '') else float(custom_price)
+            lines.append(invoice_line(part, part_id, int(item['quantity']), quote, custom_price))
+        
         # Calculate totals
-        subtotal = sum(item['quantity'] * item['unit_price'] for item in items)
-        tax_rate = 0.08  # 8% tax rate
-        tax_amount = subtotal * tax_rate
-        total = subtotal + tax_amount
+        subtotal = round(sum(line['total_price'] for line in lines), 2)
+        tax_amount = round(sum(line['tax_amount'] for line in lines), 2)
+        tax_rate = round(tax_amount / subtotal, 4) if subtotal else pricing_engine.tax_rates[None]
+        total = round(subtotal + tax_amount, 2)
         
         # Generate invoice number
         invoice_number = f"INV-{datetime.now().strftime('%Y%m%d')}-{str(uuid.uuid4())[:8].upper()}"
+        invoice_object_id = ObjectId()
+        invoice_id = str(invoice_object_id)
+        now = datetime.now()
         
         # Create invoice
         invoice_data = {
+            "_id": invoice_object_id,
             "invoice_number": invoice_number,
             "customer_id": customer_id,
-            "items": items,
+            "customer": customer_snapshot(customer),
+            "pricing_tier": pricing_tier,
+            "pricing_tier_chosen_by": tier_chosen_by,
+            "cashier": current_user["username"] if current_user else None,
+            "items": lines,
             "subtotal": subtotal,
             "tax_rate": tax_rate,
             "tax_amount": tax_amount,
@@ -694,40 +3271,40 @@ async def create_sale(request: Request):
             "payment_method": payment_method,
             "notes": notes,
             "status": "completed",
-            "created_at": datetime.now()
+            "created_at": now,
+            "snapshot_at": now
         }
         
-        invoice_result = await invoices_collection.insert_one(invoice_data)
-        invoice_id = str(invoice_result.inserted_id)
-        
-        # Update inventory and create sales records
-        for item in items:
-            part_id = ObjectId(item['part_id'])
-            quantity_sold = item['quantity']
-            
-            # Update inventory
-            await parts_collection.update_one(
-                {"_id": part_id},
-                {"$inc": {"quantity_in_stock": -quantity_sold}}
-            )
-            
-            # Create sales record
-            sale_data = {
+        # Create sales records
+        sales_records = [
+            {
                 "invoice_id": invoice_id,
-                "part_id": part_id,
-                "part_number": item['part_number'],
-                "part_name": item['part_name'],
-                "quantity_sold": quantity_sold,
-                "unit_price": item['unit_price'],
-                "total_price": item['quantity'] * item['unit_price'],
-                "sold_at": datetime.now()
+                "part_id": ObjectId(line['part_id']),
+                "part_number": line['part_number'],
+                "part_name": line['part_name'],
+                "brand": line['brand'],
+                "category": line['category'],
+                "quantity_sold": line['quantity'],
+                "unit_price": line['unit_price'],
+                "total_price": line['total_price'],
+                "sold_at": now
             }
-            await sales_collection.insert_one(sale_data)
+            for line in lines
+        ]
+        
+        try:
+            await record_sale(invoice_data, sales_records, quantities, part_numbers)
+        except InsufficientStockError as e:
+            return JSONResponse({'error': str(e), 'shortages': e.shortages}, status_code=409)
+        
+        await inventory_snapshot.refresh(list(quantities))
         
         return JSONResponse({
             'success': True,
             'invoice_id': invoice_id,
             'invoice_number': invoice_number,
+            'subtotal': subtotal,
+            'tax_amount': tax_amount,
             'total': total
         })
         
@@ -735,28 +3312,91 @@ async def create_sale(request: Request):
         print(f"Error creating sale: {e}")
         return JSONResponse({'error': str(e)}, status_code=500)
 
+INVOICES_PAGE_SIZE = 50
+
+def invoice_cursor(invoice):
+    return f"{invoice['created_at'].isoformat()}_{invoice['_id']}"
+
+def parse_invoice_cursor(cursor):
+    """(created_at, _id) from an invoice_cursor string; raises ValueError if malformed"""
+    created_at, _, invoice_id = cursor.rpartition("_")
+    try:
+        return datetime.fromisoformat(created_at), ObjectId(invoice_id)
+    except InvalidId:
+        raise ValueError(f"Invalid invoice cursor: {cursor}")
+
+async def list_invoices_page(older=None, newer=None, limit=INVOICES_PAGE_SIZE):
+    """One page of invoices, newest first, keyed on (created_at, _id) so ties don't skip rows.
+
+    older/newer are cursors of the invoices at the edges of the neighbouring
+    page. Returns (invoices, older_cursor, newer_cursor).
+    """
+    if newer:
+        created_at, invoice_id = parse_invoice_cursor(newer)
+        query = {"$or": [{"created_at": {"$gt": created_at}}, {"created_at": created_at, "_id": {"$gt": invoice_id}}]}
+        invoices = await invoices_collection.find(query).sort(
+            [("created_at", ASCENDING), ("_id", ASCENDING)]
+        ).limit(limit + 1).to_list(limit + 1)
+        has_newer = len(invoices) > limit
+        invoices = invoices[:limit][::-1]
+        older_cursor = invoice_cursor(invoices[-1]) if invoices else None
+        newer_cursor = invoice_cursor(invoices[0]) if has_newer else None
+    else:
+        query = {}
+        if older:
+            created_at, invoice_id = parse_invoice_cursor(older)
+            query = {"$or": [{"created_at": {"$lt": created_at}}, {"created_at": created_at, "_id": {"$lt": invoice_id}}]}
+        invoices = await invoices_collection.find(query).sort(
+            [("created_at", DESCENDING), ("_id", DESCENDING)]
+        ).limit(limit + 1).to_list(limit + 1)
+        has_older = len(invoices) > limit
+        invoices = invoices[:limit]
+        older_cursor = invoice_cursor(invoices[-1]) if has_older else None
+        newer_cursor = invoice_cursor(invoices[0]) if older and invoices else None
+    return invoices, older_cursor, newer_cursor
+
+async def attach_customer_names(invoices):
+    """Set customer_name on each invoice, from its snapshot or one batched lookup for older invoices"""
+    unresolved = [invoice for invoice in invoices if invoice.get('customer_id') and 'snapshot_at' not in invoice]
+    customers = await customers_by_id(invoice['customer_id'] for invoice in unresolved)
+    for invoice in invoices:
+        if not invoice.get('customer_id'):
+            continue
+        customer = invoice.get('customer') if 'snapshot_at' in invoice else customers.get(invoice['customer_id'])
+        invoice['customer_name'] = customer['name'] if customer else 'Unknown'
+    return invoices
+
 @app.get('/invoices', response_class=HTMLResponse)
-async def invoices_page(request: Request):
-    """View all invoices"""
+async def invoices_page(request: Request, older: Optional[str] = None, newer: Optional[str] = None):
+    """View invoices, a page at a time"""
     try:
-        invoices = await invoices_collection.find().sort("created_at", -1).to_list(100)
+        try:
+            invoices, older_cursor, newer_cursor = await list_invoices_page(older, newer)
+        except ValueError:
+            invoices, older_cursor, newer_cursor = await list_invoices_page()
+        await attach_customer_names(invoices)
         
-        # Get customer details for each invoice
-        for invoice in invoices:
-            if invoice.get('customer_id'):
-                try:
-                    customer = await customers_collection.find_one({"customer_id": invoice['customer_id']})
-                    invoice['customer_name'] = customer['name'] if customer else 'Unknown'
-                except Exception as e:
-                    print(f"Error fetching customer for invoice {invoice.get('_id')}: {e}")
-                    invoice['customer_name'] = 'Unknown'
+        # All-time totals from the daily rollups rather than summing every invoice
+        totals = await daily_rollups_collection.aggregate([
+            {"$group": {"_id": None, "invoice_count": {"$sum": "$invoice_count"}, "sales_total": {"$sum": "$sales_total"}}}
+        ]).to_list(1)
+        totals = totals[0] if totals else {"invoice_count": 0, "sales_total": 0}
         
-        return templates.TemplateResponse('invoices.html', {'request': request, 'invoices': invoices})
+        return templates.TemplateResponse('invoices.html', {
+            'request': request,
+            'invoices': invoices,
+            'older_cursor': older_cursor,
+            'newer_cursor': newer_cursor,
+            'invoice_count': totals['invoice_count'],
+            'sales_total': totals['sales_total']
+        })
     except Exception as e:
         print(f"Error loading invoices page: {e}")
         return templates.TemplateResponse('invoices.html', {
             'request': request, 
             'invoices': [], 
+            'invoice_count': 0,
+            'sales_total': 0,
             'error': 'Failed to load invoices. Please check database connection.'
         })
 
@@ -769,10 +3409,10 @@ async def view_invoice(request: Request, invoice_id: str):
             raise HTTPException(status_code=404, detail="Invoice not found")
         
         # Get customer details
-        customer = None
-        if invoice.get('customer_id'):
+        customer = invoice.get('customer')
+        if invoice.get('customer_id') and 'snapshot_at' not in invoice:
             try:
-                customer = await customers_collection.find_one({"customer_id": invoice['customer_id']})
+                customer = (await customers_by_id([invoice['customer_id']])).get(invoice['customer_id'])
             except Exception as e:
                 print(f"Error fetching customer for invoice {invoice_id}: {e}")
                 customer = None
@@ -864,6 +3504,7 @@ async def add_expense(
         }
         
         await expenses_collection.insert_one(expense_data)
+        await increment_daily_rollup(expense_data["date"], expenses_total=amount, expense_count=1)
         return RedirectResponse(url='/expenses', status_code=303)
     except Exception as e:
         print(f"Error adding expense: {e}")
@@ -872,7 +3513,14 @@ async def add_expense(
 @app.get('/expenses/delete/{expense_id}')
 async def delete_expense(expense_id: str):
     """Delete expense"""
-    await expenses_collection.delete_one({"_id": ObjectId(expense_id)})
+    expense = await expenses_collection.find_one_and_delete({"_id": ObjectId(expense_id)})
+    if expense and isinstance(expense.get("date"), datetime):
+        amount = expense.get("amount")
+        await increment_daily_rollup(
+            expense["date"],
+            expenses_total=-amount if isinstance(amount, (int, float)) else 0,
+            expense_count=-1
+        )
     return RedirectResponse(url='/expenses', status_code=303)
 
 # ==================== CUSTOMER MANAGEMENT ====================
@@ -883,14 +3531,25 @@ async def customers_page(request: Request):
     customers = await customers_collection.find().sort("created_at", -1).to_list(100)
     return templates.TemplateResponse('customers.html', {'request': request, 'customers': customers})
 
+def valid_pricing_tier(tier):
+    return tier == DEFAULT_PRICING_TIER or tier in pricing_engine.tier_discounts
+
 @app.post('/customers/add')
 async def add_customer(
+    request: Request,
     name: str = Form(...),
     email: str = Form(...),
     phone: str = Form(...),
-    address: str = Form(...)
+    address: str = Form(...),
+    pricing_tier: str = Form(DEFAULT_PRICING_TIER)
 ):
     """Add new customer"""
+    if not valid_pricing_tier(pricing_tier):
+        return RedirectResponse(url='/customers?error=Unknown pricing tier', status_code=303)
+    if pricing_tier != DEFAULT_PRICING_TIER:
+        current_user = await current_user_or_none(request)
+        if current_user is None or current_user.get("role") != "admin":
+            return RedirectResponse(url='/customers?error=Only admins can give customers a discount tier', status_code=303)
     try:
         # Generate customer ID
         customer_id = f"CUST{str(uuid.uuid4())[:6].upper()}"
@@ -901,6 +3560,7 @@ async def add_customer(
             "email": email,
             "phone": phone,
             "address": address,
+            "pricing_tier": pricing_tier,
             "created_at": datetime.now()
         }
         
@@ -910,95 +3570,327 @@ async def add_customer(
         print(f"Error adding customer: {e}")
         return RedirectResponse(url='/customers?error=Failed to add customer', status_code=303)
 
+@app.post('/api/customers/{customer_id}/pricing-tier')
+async def set_customer_pricing_tier(customer_id: str, request: Request, current_user = Depends(get_current_admin_user)):
+    """Set the pricing tier a customer's sales are charged at (admin only)"""
+    data = await request.json()
+    pricing_tier = data.get('pricing_tier')
+    if not valid_pricing_tier(pricing_tier):
+        return JSONResponse({'error': f"Unknown pricing tier: {pricing_tier}"}, status_code=400)
+    try:
+        result = await customers_collection.update_one(
+            {"customer_id": customer_id},
+            {"$set": {"pricing_tier": pricing_tier, "updated_at": datetime.now(), "updated_by": current_user["username"]}}
+        )
+        if result.matched_count == 0:
+            return JSONResponse({'error': 'Customer not found'}, status_code=404)
+        return JSONResponse({'success': True, 'customer_id': customer_id, 'pricing_tier': pricing_tier})
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+# ==================== DAILY ROLLUPS ====================
+
+def rollup_day(moment):
+    """Rollup row id and midnight datetime for the day containing moment"""
+    day = datetime.combine(moment.date(), datetime.min.time())
+    return day.strftime('%Y-%m-%d'), day
+
+async def increment_daily_rollup(moment, sales_total=0, invoice_count=0, expenses_total=0, expense_count=0, session=None):
+    """Add a sale or expense to the rollup row of its day"""
+    day_id, day = rollup_day(moment)
+    await daily_rollups_collection.update_one(
+        {"_id": day_id},
+        {
+            "$inc": {
+                "sales_total": sales_total,
+                "invoice_count": invoice_count,
+                "expenses_total": expenses_total,
+                "expense_count": expense_count
+            },
+            "$set": {"date": day, "updated_at": datetime.now()}
+        },
+        upsert=True,
+        session=session
+    )
+
+async def rebuild_daily_rollups():
+    """Recompute every rollup row from invoices and expenses; returns the number of days"""
+    days = defaultdict(lambda: {"sales_total": 0, "invoice_count": 0, "expenses_total": 0, "expense_count": 0})
+    
+    invoice_days = invoices_collection.aggregate([
+        {"$match": {"created_at": {"$type": "date"}}},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+            "total": {"$sum": "$total"},
+            "count": {"$sum": 1}
+        }}
+    ])
+    async for row in invoice_days:
+        days[row["_id"]]["sales_total"] = row["total"]
+        days[row["_id"]]["invoice_count"] = row["count"]
+    
+    expense_days = expenses_collection.aggregate([
+        {"$match": {"date": {"$type": "date"}}},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$date"}},
+            "total": {"$sum": "$amount"},
+            "count": {"$sum": 1}
+        }}
+    ])
+    async for row in expense_days:
+        days[row["_id"]]["expenses_total"] = row["total"]
+        days[row["_id"]]["expense_count"] = row["count"]
+    
+    now = datetime.now()
+    operations = [
+        ReplaceOne(
+            {"_id": day_id},
+            {**values, "date": datetime.strptime(day_id, "%Y-%m-%d"), "updated_at": now},
+            upsert=True
+        )
+        for day_id, values in days.items()
+    ]
+    for i in range(0, len(operations), 1000):
+        await daily_rollups_collection.bulk_write(operations[i:i + 1000], ordered=False)
+    await daily_rollups_collection.delete_many({"_id": {"$nin": list(days)}})
+    return len(days)
+
+# ==================== INVOICE SNAPSHOTS ====================
+
+INVOICE_BACKFILL_BATCH_SIZE = 500
+
+async def backfill_invoice_snapshots(batch_size=INVOICE_BACKFILL_BATCH_SIZE):
+    """Freeze customer and part details onto invoices created before create_sale did.
+
+    Works through invoices without snapshot_at in _id order, one batch at a
+    time, with one customer and one part lookup per batch. Uses the current
+    customer and part records, which is the closest available to the state
+    at sale time. Returns the number of invoices updated.
+    """
+    updated = 0
+    last_id = None
+    while True:
+        query = {"snapshot_at": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        invoices = await invoices_collection.find(query).sort("_id", ASCENDING).limit(batch_size).to_list(batch_size)
+        if not invoices:
+            return updated
+        last_id = invoices[-1]["_id"]
+        
+        customers = await customers_by_id(invoice.get("customer_id") for invoice in invoices)
+        part_ids = set()
+        for invoice in invoices:
+            for item in invoice.get("items", []):
+                try:
+                    part_ids.add(ObjectId(item.get("part_id")))
+                except (InvalidId, TypeError):
+                    pass
+        parts = {}
+        if part_ids:
+            async for part in parts_collection.find({"_id": {"$in": list(part_ids)}}):
+                parts[str(part["_id"])] = part
+        
+        now = datetime.now()
+        operations = []
+        for invoice in invoices:
+            lines = []
+            for item in invoice.get("items", []):
+                part = parts.get(str(item.get("part_id")), {})
+                quantity = item.get("quantity", 0)
+                unit_price = item.get("unit_price", 0)
+                lines.append({
+                    "part_id": str(item.get("part_id")),
+                    "part_number": item.get("part_number") or part.get("part_number"),
+                    "part_name": item.get("part_name") or part.get("part_name"),
+                    "brand": item.get("brand") or part.get("brand"),
+                    "category": item.get("category") or part.get("category"),
+                    "quantity": quantity,
+                    "unit_price": unit_price,
+                    "total_price": item.get("total_price", quantity * unit_price)
+                })
+            operations.append(UpdateOne({"_id": invoice["_id"], "snapshot_at": {"$exists": False}}, {"$set": {
+                "customer": customer_snapshot(customers.get(invoice.get("customer_id"))),
+                "pricing_tier": invoice.get("pricing_tier"),
+                "items": lines,
+                "snapshot_at": now,
+                "snapshot_backfilled": True
+            }}))
+        result = await invoices_collection.bulk_write(operations, ordered=False)
+        updated += result.modified_count
+
+# ==================== REORDER SUGGESTIONS ====================
+
+# Sales history used for the daily sales rate, supplier lead time, and days of
+# sales an order should cover on top of the minimum stock level
+REORDER_VELOCITY_DAYS = int(os.getenv('REORDER_VELOCITY_DAYS', '30'))
+REORDER_LEAD_TIME_DAYS = int(os.getenv('REORDER_LEAD_TIME_DAYS', '7'))
+REORDER_COVER_DAYS = int(os.getenv('REORDER_COVER_DAYS', '14'))
+
+async def sales_velocity(days, now=None):
+    """Units sold per day for every part sold in the last days, keyed by part _id"""
+    since = (now or datetime.now()) - timedelta(days=days)
+    pipeline = [
+        {"$match": {"sold_at": {"$gte": since}}},
+        {"$group": {"_id": "$part_id", "sold": {"$sum": "$quantity_sold"}}}
+    ]
+    return {row["_id"]: row["sold"] / days async for row in sales_collection.aggregate(pipeline)}
+
+def reorder_line(part, daily_velocity, lead_time_days, cover_days):
+    """Suggested order for one part, or None when its stock outlasts the lead time.
+
+    The target is the minimum stock level plus the sales expected while the order
+    is on its way and over the cover period, so a part is only suggested when it
+    is already below its minimum or will run out before a new order could arrive.
+    """
+    quantity = part.get("quantity_in_stock") or 0
+    minimum = part.get("minimum_stock_level") or 0
+    expected_during_lead_time = daily_velocity * lead_time_days
+    if quantity >= minimum and quantity > expected_during_lead_time:
+        return None
+    target = minimum + math.ceil(daily_velocity * (lead_time_days + cover_days))
+    order_quantity = target - quantity
+    if order_quantity <= 0:
+        return None
+    unit_price = part.get("unit_price") or 0
+    return {
+        "part_id": str(part["_id"]),
+        "part_number": part.get("part_number"),
+        "part_name": part.get("part_name"),
+        "quantity_in_stock": quantity,
+        "minimum_stock_level": minimum,
+        "shortfall": max(minimum - quantity, 0),
+        "daily_velocity": round(daily_velocity, 2),
+        "days_of_stock_left": round(quantity / daily_velocity, 1) if daily_velocity else None,
+        "order_quantity": order_quantity,
+        "estimated_cost": round(order_quantity * unit_price, 2)
+    }
+
+async def reorder_suggestions(days=REORDER_VELOCITY_DAYS, lead_time_days=REORDER_LEAD_TIME_DAYS,
+                              cover_days=REORDER_COVER_DAYS, supplier=None):
+    """Order quantities grouped by supplier, for low-stock parts and fast sellers about to run out"""
+    velocity = await sales_velocity(days)
+    query = {"$or": [{"is_low_stock": True}, {"_id": {"$in": list(velocity)}}]}
+    if supplier:
+        query["supplier"] = supplier
+    projection = {"part_number": 1, "part_name": 1, "supplier": 1, "quantity_in_stock": 1,
+                  "minimum_stock_level": 1, "unit_price": 1}
+    
+    by_supplier = defaultdict(list)
+    async for part in parts_collection.find(query, projection):
+        line = reorder_line(part, velocity.get(part["_id"], 0), lead_time_days, cover_days)
+        if line:
+            by_supplier[part.get("supplier") or ""].append(line)
+    
+    suppliers = []
+    for name, lines in by_supplier.items():
+        lines.sort(key=lambda line: (-line["shortfall"], line["days_of_stock_left"] is None, line["days_of_stock_left"] or 0))
+        suppliers.append({
+            "supplier": name,
+            "lines": lines,
+            "total_units": sum(line["order_quantity"] for line in lines),
+            "estimated_cost": round(sum(line["estimated_cost"] for line in lines), 2)
+        })
+    suppliers.sort(key=lambda group: -group["estimated_cost"])
+    return suppliers
+
+@app.get('/api/reorder-suggestions')
+async def get_reorder_suggestions(days: int = REORDER_VELOCITY_DAYS, lead_time_days: int = REORDER_LEAD_TIME_DAYS,
+                                  cover_days: int = REORDER_COVER_DAYS, supplier: Optional[str] = None):
+    """Suggested purchase orders per supplier from stock levels and recent sales velocity"""
+    if days < 1 or lead_time_days < 0 or cover_days < 0:
+        return JSONResponse({'error': 'days must be at least 1 and lead and cover days not negative'}, status_code=400)
+    try:
+        suppliers = await reorder_suggestions(days, lead_time_days, cover_days, supplier)
+        return JSONResponse({
+            'velocity_days': days,
+            'lead_time_days': lead_time_days,
+            'cover_days': cover_days,
+            'generated_at': datetime.now().isoformat(),
+            'suppliers': suppliers
+        })
+    except Exception as e:
+        print(f"Error building reorder suggestions: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
 # ==================== ENHANCED DASHBOARD ====================
 
+def dashboard_windows(today):
+    """Start and end datetimes of today, this week, this month and this year"""
+    start_of_day = datetime.combine(today, datetime.min.time())
+    end_of_day = datetime.combine(today, datetime.max.time())
+    
+    # This week
+    start_of_week = start_of_day - timedelta(days=today.weekday())
+    end_of_week = end_of_day + timedelta(days=6-today.weekday())
+    
+    # This month
+    start_of_month = datetime(today.year, today.month, 1)
+    if today.month == 12:
+        end_of_month = datetime(today.year + 1, 1, 1) - timedelta(seconds=1)
+    else:
+        end_of_month = datetime(today.year, today.month + 1, 1) - timedelta(seconds=1)
+    
+    # This year
+    start_of_year = datetime(today.year, 1, 1)
+    end_of_year = datetime(today.year + 1, 1, 1) - timedelta(seconds=1)
+    
+    return {
+        "today": (start_of_day, end_of_day),
+        "week": (start_of_week, end_of_week),
+        "month": (start_of_month, end_of_month),
+        "year": (start_of_year, end_of_year)
+    }
+
+async def rollup_totals(windows):
+    """Sales and expense totals per window, summed from daily rollup rows"""
+    earliest = min(start for start, _ in windows.values())
+    latest = max(end for _, end in windows.values())
+    rows = await daily_rollups_collection.find(
+        {"date": {"$gte": earliest, "$lte": latest}},
+        {"date": 1, "sales_total": 1, "expenses_total": 1}
+    ).to_list(None)
+    
+    totals = {}
+    for name, (start, end) in windows.items():
+        in_window = [row for row in rows if start <= row["date"] <= end]
+        totals[name] = (
+            sum(row.get("sales_total", 0) for row in in_window),
+            sum(row.get("expenses_total", 0) for row in in_window)
+        )
+    return totals
+
 @app.get('/api/dashboard-stats')
 async def get_dashboard_stats():
     """Get enhanced dashboard statistics"""
     try:
-        # Today's date
-        today = datetime.now().date()
-        start_of_day = datetime.combine(today, datetime.min.time())
-        end_of_day = datetime.combine(today, datetime.max.time())
-        
-        # This week
-        start_of_week = start_of_day - timedelta(days=today.weekday())
-        end_of_week = end_of_day + timedelta(days=6-today.weekday())
-        
-        # This month
-        start_of_month = datetime(today.year, today.month, 1)
-        end_of_month = datetime(today.year, today.month + 1, 1) - timedelta(seconds=1)
-        
-        # Sales statistics
-        today_sales = await invoices_collection.find({
-            "created_at": {"$gte": start_of_day, "$lte": end_of_day}
-        }).to_list(1000)
-        
-        week_sales = await invoices_collection.find({
-            "created_at": {"$gte": start_of_week, "$lte": end_of_week}
-        }).to_list(1000)
-        
-        month_sales = await invoices_collection.find({
-            "created_at": {"$gte": start_of_month, "$lte": end_of_month}
-        }).to_list(1000)
-        
-        # Calculate totals
-        today_total = sum(sale['total'] for sale in today_sales)
-        week_total = sum(sale['total'] for sale in week_sales)
-        month_total = sum(sale['total'] for sale in month_sales)
-        
-        # Expense statistics
-        today_expenses = await expenses_collection.find({
-            "date": {"$gte": start_of_day, "$lte": end_of_day}
-        }).to_list(1000)
-        
-        week_expenses = await expenses_collection.find({
-            "date": {"$gte": start_of_week, "$lte": end_of_week}
-        }).to_list(1000)
-        
-        month_expenses = await expenses_collection.find({
-            "date": {"$gte": start_of_month, "$lte": end_of_month}
-        }).to_list(1000)
-        
-        # Calculate expense totals with error handling
-        today_expense_total = 0
-        week_expense_total = 0
-        month_expense_total = 0
-        
-        for expense in today_expenses:
-            try:
-                today_expense_total += expense.get('amount', 0)
-            except (TypeError, ValueError):
-                continue
-                
-        for expense in week_expenses:
-            try:
-                week_expense_total += expense.get('amount', 0)
-            except (TypeError, ValueError):
-                continue
-                
-        for expense in month_expenses:
-            try:
-                month_expense_total += expense.get('amount', 0)
-            except (TypeError, ValueError):
-                continue
+        totals = await rollup_totals(dashboard_windows(datetime.now().date()))
         
-        return JSONResponse({
-            'today_sales': today_total,
-            'week_sales': week_total,
-            'month_sales': month_total,
-            'today_expenses': today_expense_total,
-            'week_expenses': week_expense_total,
-            'month_expenses': month_expense_total,
-            'today_profit': today_total - today_expense_total,
-            'week_profit': week_total - week_expense_total,
-            'month_profit': month_total - month_expense_total
-        })
+        stats = {}
+        for name, (sales_total, expenses_total) in totals.items():
+            stats[f'{name}_sales'] = sales_total
+            stats[f'{name}_expenses'] = expenses_total
+            stats[f'{name}_profit'] = sales_total - expenses_total
+        return JSONResponse(stats)
         
     except Exception as e:
         print(f"Error getting dashboard stats: {e}")
         return JSONResponse({'error': str(e)}, status_code=500)
 
+@app.get('/api/metrics')
+async def get_metrics():
+    """In-process cache and sync metrics; with several workers each process reports its own"""
+    return JSONResponse({
+        'instance': INSTANCE_ID,
+        'mongo_pool': pool_metrics.stats(),
+        'inventory_snapshot': inventory_snapshot.stats(),
+        'llm': llm_limiter.stats(),
+        'chat_cache': chat_response_cache.stats(),
+        'user_cache': user_cache.stats(),
+        'pricing': pricing_engine.stats(),
+        'jobs': job_queue.stats()
+    })
+
 @app.get('/api/export-chat/{session_id}')
 async def export_chat_to_pdf(session_id: str):
     """Export chat session to PDF"""
@@ -1033,6 +3925,372 @@ async def export_chat_to_pdf(session_id: str):
     except Exception as e:
         return JSONResponse({'error': str(e)}, status_code=500)
 
+# ==================== JOB QUEUE ====================
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', '2'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# A running job whose lease runs out (worker crashed or was killed) is picked up again
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '60'))
+JOB_RETRY_BASE_SECONDS = 5
+
+SMTP_SERVER = os.getenv('SMTP_SERVER', '')
+SMTP_PORT = int(os.getenv('SMTP_PORT') or '587')
+SMTP_USERNAME = os.getenv('SMTP_USERNAME', '')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', '')
+
+class PermanentJobError(Exception):
+    """Raised by a job handler when retrying cannot help"""
+
+class JobQueue:
+    """Persistent job queue on the jobs collection.
+
+    Jobs are claimed with an atomic find_one_and_update, so any number of
+    workers in any number of processes can share the collection. A running
+    job holds a lease that its worker renews; if the worker dies the lease
+    expires and the job is claimed again. Failures are retried with
+    exponential backoff up to max_attempts, and a running job can be
+    cancelled by setting cancel_requested on it.
+    """
+
+    def __init__(self, workers=2, poll_interval=2.0, max_attempts=3, lease_seconds=60.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.running = {}
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.cancelled = 0
+        self._tasks = []
+        self._wakeup = None
+        self._stopping = False
+
+    async def enqueue(self, job_type, payload=None, max_attempts=None, **fields):
+        """Insert a queued job and return its id"""
+        now = datetime.now()
+        job = {
+            "type": job_type,
+            "status": "queued",
+            "payload": payload or {},
+            "attempts": 0,
+            "max_attempts": max_attempts or self.max_attempts,
+            "run_after": now,
+            "created_at": now,
+            **fields
+        }
+        result = await jobs_collection.insert_one(job)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return result.inserted_id
+
+    async def claim(self):
+        """Take the oldest due job, or one whose worker stopped renewing its lease"""
+        now = datetime.now()
+        return await jobs_collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_after": {"$lte": now}},
+                {"status": "running", "lease_expires_at": {"$lt": now}}
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "started_at": now,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                    "worker": self.worker_id
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_after", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def start(self):
+        if not self._tasks:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers; jobs they were running go back on the queue"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self.claim()
+            except PyMongoError as e:
+                print(f"Job queue error: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job):
+        job_id = job["_id"]
+        handler = JOB_HANDLERS.get(job["type"])
+        if handler is None:
+            await self._finish(job, "failed", error=f"No handler for job type '{job['type']}'")
+            return
+        if job["attempts"] > job.get("max_attempts", self.max_attempts):
+            await self._finish(job, "failed", error=job.get("last_error") or "Worker lost while running the job")
+            return
+        
+        task = asyncio.create_task(handler(job))
+        self.running[job_id] = job["type"]
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=self.lease_seconds / 3)
+                if task.done():
+                    break
+                current = await jobs_collection.find_one_and_update(
+                    {"_id": job_id},
+                    {"$set": {"lease_expires_at": datetime.now() + timedelta(seconds=self.lease_seconds)}},
+                    projection={"cancel_requested": 1}
+                )
+                if current is None or current.get("cancel_requested"):
+                    task.cancel()
+            result = await task
+        except asyncio.CancelledError:
+            if self._stopping:
+                task.cancel()
+                await jobs_collection.update_one({"_id": job_id, "status": "running"}, {
+                    "$set": {"status": "queued", "run_after": datetime.now()},
+                    "$inc": {"attempts": -1}
+                })
+                raise
+            self.cancelled += 1
+            await self._finish(job, "cancelled")
+        except PermanentJobError as e:
+            await self._finish(job, "failed", error=str(e))
+        except Exception as e:
+            print(f"Job {job_id} ({job['type']}) attempt {job['attempts']} failed: {e}")
+            if job["attempts"] < job.get("max_attempts", self.max_attempts):
+                self.retried += 1
+                delay = JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1)
+                await jobs_collection.update_one({"_id": job_id}, {
+                    "$set": {
+                        "status": "queued",
+                        "run_after": datetime.now() + timedelta(seconds=delay),
+                        "last_error": str(e)
+                    },
+                    "$unset": {"lease_expires_at": ""}
+                })
+            else:
+                await self._finish(job, "failed", error=str(e))
+        else:
+            await self._finish(job, "completed", result=result)
+        finally:
+            self.running.pop(job_id, None)
+
+    async def _finish(self, job, status, result=None, error=None):
+        if status == "completed":
+            self.completed += 1
+        elif status == "failed":
+            self.failed += 1
+        update = {"status": status, "finished_at": datetime.now()}
+        if result is not None:
+            update["result"] = result
+        if error is not None:
+            update["last_error"] = error
+        try:
+            await jobs_collection.update_one({"_id": job["_id"]}, {"$set": update, "$unset": {"lease_expires_at": ""}})
+        except PyMongoError as e:
+            print(f"Error finishing job {job['_id']}: {e}")
+        cleanup = JOB_CLEANUP.get(job["type"])
+        if cleanup:
+            cleanup(job)
+
+    def stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "workers": len(self._tasks),
+            "running": len(self.running),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "cancelled": self.cancelled,
+        }
+
+job_queue = JobQueue(
+    workers=JOB_WORKERS,
+    poll_interval=JOB_POLL_SECONDS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    lease_seconds=JOB_LEASE_SECONDS
+)
+
+def send_email(to, subject, body):
+    """Blocking SMTP send; run it in a thread"""
+    message = MIMEMultipart()
+    message["From"] = SMTP_USERNAME
+    message["To"] = to
+    message["Subject"] = subject
+    message.attach(MIMEText(body, "plain"))
+    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30) as server:
+        server.starttls()
+        if SMTP_USERNAME:
+            server.login(SMTP_USERNAME, SMTP_PASSWORD)
+        server.send_message(message)
+
+async def run_rebuild_daily_rollups(job):
+    """Job handler: recompute the daily rollups from invoices and expenses"""
+    return {"days": await rebuild_daily_rollups()}
+
+async def run_backfill_invoice_snapshots(job):
+    """Job handler: snapshot customer and part details onto older invoices"""
+    return {"invoices": await backfill_invoice_snapshots()}
+
+async def run_email_report(job):
+    """Job handler: email the sales/expense totals and low-stock count"""
+    if not SMTP_SERVER:
+        raise PermanentJobError("SMTP_SERVER is not configured")
+    to = job.get("payload", {}).get("to") or SMTP_USERNAME
+    if not to:
+        raise PermanentJobError("No recipient given and SMTP_USERNAME is not set")
+    
+    today = datetime.now().date()
+    totals = await rollup_totals(dashboard_windows(today))
+    low_stock = await parts_collection.count_documents({"is_low_stock": True})
+    lines = [f"SLN AUTOMOBILES - Business report for {today.isoformat()}", ""]
+    for name, (sales_total, expenses_total) in totals.items():
+        lines.append(
+            f"{name.title():<6} sales ${sales_total:,.2f}  expenses ${expenses_total:,.2f}  "
+            f"profit ${sales_total - expenses_total:,.2f}"
+        )
+    lines += ["", f"Parts below minimum stock: {low_stock}"]
+    
+    await asyncio.to_thread(send_email, to, f"SLN AUTOMOBILES report {today.isoformat()}", "\n".join(lines))
+    return {"to": to}
+
+JOB_HANDLERS = {
+    "part_import": run_part_import,
+    "rebuild_daily_rollups": run_rebuild_daily_rollups,
+    "backfill_invoice_snapshots": run_backfill_invoice_snapshots,
+    "email_report": run_email_report,
+}
+# Run when a job completes, fails for good or is cancelled, but not between retries
+JOB_CLEANUP = {
+    "part_import": remove_import_file,
+}
+# Job types that may be queued through POST /api/jobs (imports come in via their upload endpoint)
+API_JOB_TYPES = {"rebuild_daily_rollups", "backfill_invoice_snapshots", "email_report"}
+
+def serialize_job(job):
+    return {
+        'id': str(job['_id']),
+        'type': job.get('type'),
+        'status': job.get('status'),
+        'filename': job.get('filename'),
+        'payload': job.get('payload', {}),
+        'progress': job.get('progress', {}),
+        'errors': job.get('errors', []),
+        'result': job.get('result'),
+        'attempts': job.get('attempts', 0),
+        'max_attempts': job.get('max_attempts'),
+        'last_error': job.get('last_error'),
+        'cancel_requested': job.get('cancel_requested', False),
+        'created_at': job['created_at'].isoformat() if job.get('created_at') else None,
+        'started_at': job['started_at'].isoformat() if job.get('started_at') else None,
+        'finished_at': job['finished_at'].isoformat() if job.get('finished_at') else None
+    }
+
+@app.post('/api/jobs', status_code=202)
+async def create_job(request: Request, current_user = Depends(get_current_admin_user)):
+    """Queue a job (admin only): {"type": "rebuild_daily_rollups"}, {"type": "backfill_invoice_snapshots"} or {"type": "email_report", "payload": {"to": ...}}"""
+    try:
+        data = await request.json()
+        job_type = data.get('type')
+        if job_type not in API_JOB_TYPES:
+            return JSONResponse({'error': f"Unknown job type '{job_type}'", 'types': sorted(API_JOB_TYPES)}, status_code=400)
+        job_id = await job_queue.enqueue(job_type, payload=data.get('payload') or {}, requested_by=current_user["username"])
+        return JSONResponse({'success': True, 'job_id': str(job_id)}, status_code=202)
+    except Exception as e:
+        print(f"Error queueing job: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+@app.get('/api/jobs')
+async def list_jobs(status: Optional[str] = None, type: Optional[str] = None, limit: int = 50):
+    try:
+        query = {}
+        if status:
+            query["status"] = status
+        if type:
+            query["type"] = type
+        limit = max(1, min(limit, 200))
+        jobs = await jobs_collection.find(query, {"errors": 0}).sort("created_at", DESCENDING).limit(limit).to_list(limit)
+        return JSONResponse({'jobs': [serialize_job(job) for job in jobs]})
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+@app.get('/api/jobs/{job_id}')
+async def get_job(job_id: str):
+    try:
+        job = await jobs_collection.find_one({"_id": ObjectId(job_id)})
+    except InvalidId:
+        return JSONResponse({'error': 'Invalid job id'}, status_code=400)
+    if not job:
+        return JSONResponse({'error': 'Job not found'}, status_code=404)
+    return JSONResponse(serialize_job(job))
+
+@app.post('/api/jobs/{job_id}/cancel')
+async def cancel_job(job_id: str, current_user = Depends(get_current_admin_user)):
+    """Cancel a queued job outright, or ask the worker running it to stop (admin only)"""
+    try:
+        object_id = ObjectId(job_id)
+    except InvalidId:
+        return JSONResponse({'error': 'Invalid job id'}, status_code=400)
+    job = await jobs_collection.find_one_and_update(
+        {"_id": object_id, "status": "queued"},
+        {"$set": {"status": "cancelled", "finished_at": datetime.now()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if job is not None and job["type"] in JOB_CLEANUP:
+        JOB_CLEANUP[job["type"]](job)
+    if job is None:
+        job = await jobs_collection.find_one_and_update(
+            {"_id": object_id, "status": "running"},
+            {"$set": {"cancel_requested": True}},
+            return_document=ReturnDocument.AFTER
+        )
+    if job is None:
+        if await jobs_collection.count_documents({"_id": object_id}, limit=1):
+            return JSONResponse({'error': 'Job has already finished'}, status_code=409)
+        return JSONResponse({'error': 'Job not found'}, status_code=404)
+    return JSONResponse(serialize_job(job), status_code=202)
+
+@app.post('/api/jobs/{job_id}/retry')
+async def retry_job(job_id: str, current_user = Depends(get_current_admin_user)):
+    """Queue a failed or cancelled job again with a fresh set of attempts (admin only)"""
+    try:
+        object_id = ObjectId(job_id)
+    except InvalidId:
+        return JSONResponse({'error': 'Invalid job id'}, status_code=400)
+    existing = await jobs_collection.find_one({"_id": object_id}, {"path": 1})
+    if existing and existing.get("path") and not os.path.exists(existing["path"]):
+        return JSONResponse({'error': 'The uploaded file was removed when the job ended; upload it again'}, status_code=409)
+    job = await jobs_collection.find_one_and_update(
+        {"_id": object_id, "status": {"$in": ["failed", "cancelled"]}},
+        {
+            "$set": {"status": "queued", "attempts": 0, "run_after": datetime.now(), "cancel_requested": False},
+            "$unset": {"finished_at": "", "last_error": ""}
+        },
+        return_document=ReturnDocument.AFTER
+    )
+    if job is None:
+        return JSONResponse({'error': 'Only failed or cancelled jobs can be retried'}, status_code=409)
+    return JSONResponse(serialize_job(job), status_code=202)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
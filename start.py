@@ -137,10 +137,16 @@ def main():
     print("⏹️  Press Ctrl+C to stop the server")
     print("-" * 40)
     
-    # Start the application
+    # Start the application; WEB_CONCURRENCY > 1 runs several worker processes (no auto-reload)
+    workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+    if workers > 1:
+        print(f"👷 Running {workers} worker processes")
     try:
         import uvicorn
-        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+        if workers > 1:
+            uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
+        else:
+            uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
     except KeyboardInterrupt:
         print("\n👋 Server stopped")
     except Exception as e:
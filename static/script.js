@@ -6,8 +6,6 @@ document.addEventListener('DOMContentLoaded', function() {
     const stopVoiceButton = document.getElementById('stopVoiceButton');
     const voiceStatus = document.getElementById('voiceStatus');
     const exampleButtons = document.querySelectorAll('.example-question');
-    const searchInput = document.getElementById('searchInput');
-    const partsTable = document.getElementById('partsTable');
     const exportBtn = document.getElementById('exportBtn');
     let selectedLang = document.querySelector('input[name="language"]:checked')?.value || 'en-US';
     let currentSessionId = null;
@@ -19,23 +17,6 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
-    // Search functionality
-    if (searchInput && partsTable) {
-        searchInput.addEventListener('input', function() {
-            const searchTerm = this.value.toLowerCase();
-            const rows = partsTable.querySelectorAll('tr');
-            
-            rows.forEach(row => {
-                const text = row.textContent.toLowerCase();
-                if (text.includes(searchTerm)) {
-                    row.style.display = '';
-                } else {
-                    row.style.display = 'none';
-                }
-            });
-        });
-    }
-
     // Append message to chat
     function appendMessage(content, sender) {
         const messageDiv = document.createElement('div');
@@ -46,9 +27,29 @@ document.addEventListener('DOMContentLoaded', function() {
         messageDiv.appendChild(contentDiv);
         chatMessages.appendChild(messageDiv);
         chatMessages.scrollTop = chatMessages.scrollHeight;
+        return contentDiv;
+    }
+
+    // Handle one server-sent event from the streaming chat API
+    function handleStreamEvent(event, contentDiv, state) {
+        if (event.session_id) {
+            currentSessionId = event.session_id;
+            if (exportBtn) exportBtn.style.display = 'inline-block';
+        }
+        if (event.token) {
+            state.text += event.token;
+            contentDiv.textContent = state.text;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
+        if (event.error) {
+            contentDiv.textContent = state.text + (state.text ? '\n' : '') + 'Error: ' + event.error;
+        }
+        if (event.done && state.text) {
+            speakText(state.text, selectedLang);
+        }
     }
 
-    // Send message to backend
+    // Send message to backend and render the answer as it streams in
     function sendMessage(text) {
         if (!text) return;
         appendMessage(text, 'user');
@@ -63,28 +64,37 @@ document.addEventListener('DOMContentLoaded', function() {
             requestData.session_id = currentSessionId;
         }
         
-        fetch('/api/chat', {
+        const contentDiv = appendMessage('...', 'bot');
+        const state = { text: '' };
+        
+        fetch('/api/chat/stream', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify(requestData)
         })
-        .then(res => res.json())
-        .then(data => {
-            if (data.response) {
-                appendMessage(data.response, 'bot');
-                speakText(data.response, selectedLang);
-                
-                // Store session ID and show export button
-                if (data.session_id) {
-                    currentSessionId = data.session_id;
-                    if (exportBtn) exportBtn.style.display = 'inline-block';
-                }
-            } else if (data.error) {
-                appendMessage('Error: ' + data.error, 'bot');
+        .then(async res => {
+            if (!res.ok || !res.body) {
+                const data = await res.json();
+                throw data.error || res.statusText;
+            }
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\n\n');
+                buffer = events.pop();
+                events.forEach(raw => {
+                    if (raw.startsWith('data: ')) {
+                        handleStreamEvent(JSON.parse(raw.slice(6)), contentDiv, state);
+                    }
+                });
             }
         })
         .catch(err => {
-            appendMessage('Error: ' + err, 'bot');
+            contentDiv.textContent = 'Error: ' + err;
         });
     }
 
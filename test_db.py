@@ -1,6 +1,6 @@
 import asyncio
 import os
-from motor.motor_asyncio import AsyncIOMotorClient
+from main import create_mongo_client, MONGO_DB_NAME
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,14 +13,14 @@ async def test_mongodb_connection():
         print(f"Testing connection to: {mongo_uri}")
         
         # Create client
-        client = AsyncIOMotorClient(mongo_uri)
+        client = create_mongo_client(mongo_uri)
         
         # Test connection
         await client.admin.command('ping')
         print("✅ MongoDB connection successful!")
         
         # Test database access
-        db = client['inventory_db']
+        db = client[MONGO_DB_NAME]
         print("✅ Database 'inventory_db' accessible")
         
         # Test collections